@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
 
 import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import gzip
+import heapq
+import json
 import os
 import re
 import datetime
+import fractions
 import sys
-from dataclasses import dataclass
+import time
+from dataclasses import asdict, dataclass
 
 
 @dataclass
@@ -23,127 +32,560 @@ RE_LOG = re.compile(r"(\d+)-(\d+)-(\d+) (\d+)\:(\d+)\:(\d+),(\d+) (\w+) (.*)")
 RE_SPLIT = re.compile(r"Processing split\: gs\://.+_(\d+)\:.*")
 RE_TestDFSIO_T = re.compile(r"Exec time = (\d+)")
 RE_TestDFSIO_R = re.compile(r"IO rate = (\d*\.\d+|\d+)")
+# syslog plus log4j rotations (syslog.1 is the newest), optionally gzipped
+RE_SYSLOG_FILE = re.compile(r"^syslog(?:\.(\d+))?(?:\.gz)?$")
+MAP_TASK = "org.apache.hadoop.mapred.MapTask"
+TEST_DFSIO = "org.apache.hadoop.fs.TestDFSIO:"
+CLOG_TAIL_LIMIT = 1024
+TIMELINE_COLUMNS = ["time", "tasks", "downloads", "throughput"]
+CLOG_TIME_FIELDS = ["start_time", "end_time", "map_start_time", "fs_start_time"]
+SCALING_PERCENTILES = [10, 50, 90]
+USL_FIT_ROUNDS = 4
+USL_GRID_SIZE = 40
 
 
-def clog_reader(path):
-  with open(os.path.join(path, "syslog")) as f:
-    for l in f.readlines():
-      mo = RE_LOG.match(l.strip())
-      if mo:
-        time = datetime.datetime(
-            int(mo.group(1)),
-            int(mo.group(2)),
-            int(mo.group(3)),
-            int(mo.group(4)),
-            int(mo.group(5)),
-            int(mo.group(6)),
-            int(mo.group(7)) * 1000,
-            tzinfo=datetime.timezone.utc)
-        level = mo.group(8)
-        msg = mo.group(9)
-        yield (time, level, msg)
-
-
-def analyze_clog(path):
+@dataclass
+class TimelinePoint:
+  time: datetime.datetime
+  tasks: int = 0
+  downloads: int = 0
+  throughput: float = 0
+
+
+def get_syslog_files(files):
+  names = [f for f in files if RE_SYSLOG_FILE.match(f)]
+  return sorted(
+      names, key=lambda f: -int(RE_SYSLOG_FILE.match(f).group(1) or 0))
+
+
+def syslog_lines(path, files):
+  for name in files:
+    file_path = os.path.join(path, name)
+    if name.endswith(".gz"):
+      f = gzip.open(file_path, "rt")
+    else:
+      f = open(file_path)
+    with f:
+      yield from f
+
+
+def parse_log_time(mo):
+  return datetime.datetime(
+      int(mo.group(1)),
+      int(mo.group(2)),
+      int(mo.group(3)),
+      int(mo.group(4)),
+      int(mo.group(5)),
+      int(mo.group(6)),
+      int(mo.group(7)) * 1000,
+      tzinfo=datetime.timezone.utc)
+
+
+def last_log_match(lines):
+  for l in reversed(lines):
+    mo = RE_LOG.match(l)
+    if mo:
+      return mo
+  return None
+
+
+def analyze_clog(path, files=("syslog",)):
   d = ClogDigest()
-  for time, level, msg in clog_reader(path):
+  last = None
+  # Lines after `last` that only matter if one of them is the final log line
+  tail = []
+  for l in syslog_lines(path, files):
+    l = l.strip()
+    if not l[:1].isdigit():
+      continue
+    if d.start_time and MAP_TASK not in l and TEST_DFSIO not in l:
+      tail.append(l)
+      if len(tail) >= CLOG_TAIL_LIMIT:
+        last = last_log_match(tail) or last
+        tail = []
+      continue
+    mo = RE_LOG.match(l)
+    if not mo:
+      continue
+    last = mo
+    tail = []
+    msg = mo.group(9)
     if not d.start_time:
-      d.start_time = time
-    d.end_time = time
-    if "org.apache.hadoop.mapred.MapTask" in msg:
-      mo = RE_SPLIT.search(msg)
-      if mo:
-        d.map_start_time = time
-        d.map_split = mo.group(1)
-    if "org.apache.hadoop.fs.TestDFSIO:" in msg:
+      d.start_time = parse_log_time(mo)
+    if MAP_TASK in msg:
+      mo_split = RE_SPLIT.search(msg)
+      if mo_split:
+        d.map_start_time = parse_log_time(mo)
+        d.map_split = mo_split.group(1)
+    if TEST_DFSIO in msg:
       if "in = org.apache.hadoop.fs.FSDataInputStream" in msg:
-        d.fs_start_time = time
-      mo = RE_TestDFSIO_T.search(msg)
-      if mo:
-        d.fs_exec_time = int(mo.group(1)) / 1000.0
-      mo = RE_TestDFSIO_R.search(msg)
-      if mo:
-        d.fs_io_rate = float(mo.group(1))
+        d.fs_start_time = parse_log_time(mo)
+      mo_t = RE_TestDFSIO_T.search(msg)
+      if mo_t:
+        d.fs_exec_time = int(mo_t.group(1)) / 1000.0
+      mo_r = RE_TestDFSIO_R.search(msg)
+      if mo_r:
+        d.fs_io_rate = float(mo_r.group(1))
+  last = last_log_match(tail) or last
+  if last:
+    d.end_time = parse_log_time(last)
   return d
 
 
+def analyze_clog_files(args):
+  return analyze_clog(*args)
+
+
+class DigestCache:
+  # ClogDigests by container path, valid while its syslog files keep their
+  # names, sizes and mtimes. Persisted as JSON lines when given a path.
+
+  def __init__(self, path=None):
+    self.path = path
+    self.entries = {}
+    self.dirty = False
+    if path and os.path.exists(path):
+      with open(path) as f:
+        for line in f:
+          o = json.loads(line)
+          self.entries[o["path"]] = (o["files"], o["digest"])
+
+  def get(self, path, signature):
+    entry = self.entries.get(path)
+    if entry is None or entry[0] != signature:
+      return None
+    digest = dict(entry[1])
+    for k in CLOG_TIME_FIELDS:
+      if digest[k]:
+        digest[k] = datetime.datetime.fromisoformat(digest[k])
+    return ClogDigest(**digest)
+
+  def put(self, path, signature, d):
+    digest = asdict(d)
+    for k in CLOG_TIME_FIELDS:
+      if digest[k]:
+        digest[k] = digest[k].isoformat()
+    self.entries[path] = (signature, digest)
+    self.dirty = True
+
+  def save(self):
+    if not self.path or not self.dirty:
+      return
+    with open(self.path + ".tmp", "w") as f:
+      for path, (signature, digest) in sorted(self.entries.items()):
+        o = {"path": path, "files": signature, "digest": digest}
+        f.write(json.dumps(o) + "\n")
+    os.replace(self.path + ".tmp", self.path)
+    self.dirty = False
+
+
+def get_syslog_signature(path, files):
+  signature = []
+  for name in files:
+    st = os.stat(os.path.join(path, name))
+    signature.append([name, st.st_size, st.st_mtime_ns])
+  return signature
+
+
+def analyze_clogs(input_dir, jobs, cache):
+  digests = []
+  misses = []
+  for p in os.walk(input_dir):
+    files = get_syslog_files(p[2])
+    if not files:
+      continue
+    try:
+      signature = get_syslog_signature(p[0], files)
+    except OSError:
+      # Rotated away while listing; picked up on the next pass
+      continue
+    d = cache.get(p[0], signature)
+    if d is None:
+      misses.append((p[0], files, signature))
+    else:
+      digests.append(d)
+  if misses:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+      parsed = executor.map(
+          analyze_clog_files, [m[:2] for m in misses],
+          chunksize=max(1, len(misses) // (4 * (jobs or os.cpu_count()))))
+      for (path, _, signature), d in zip(misses, parsed):
+        cache.put(path, signature, d)
+        digests.append(d)
+  return [d for d in digests if d.fs_start_time]
+
+
 def build_pipelines(digests):
+  # Each task goes to the lowest-numbered lane that is free by its start
   pipelines = []
+  busy = []
+  free = []
   for d in sorted(digests, key=lambda x: x.start_time):
-    ai = -1
-    for i, pipeline in enumerate(pipelines):
-      if pipeline[-1].end_time < d.start_time:
-        ai = i
-        break
-    if ai == -1:
+    while busy and busy[0][0] < d.start_time:
+      heapq.heappush(free, heapq.heappop(busy)[1])
+    if free:
+      ai = heapq.heappop(free)
+    else:
       pipelines.append([])
       ai = len(pipelines) - 1
     pipelines[ai].append(d)
+    heapq.heappush(busy, (d.end_time, ai))
   return pipelines
 
 
+def get_bucket_times(ds, resolution):
+  min_time = min(d.start_time for d in ds).replace(microsecond=0)
+  max_time = max(d.end_time for d in ds).replace(microsecond=0)
+  cur_time = min_time
+  while cur_time <= max_time:
+    yield cur_time
+    cur_time = cur_time + resolution
+
+
+def build_timeline(ds, resolution):
+  # Samples running tasks, downloads and fs_io_rate per bucket. Tasks span
+  # one more bucket on each side and downloads end one early, as in the lanes.
+  events = []
+  for d in ds:
+    fs_end_time = d.fs_start_time + datetime.timedelta(seconds=d.fs_exec_time)
+    events.append((d.start_time - resolution, 1, 0, 0))
+    events.append((d.end_time + resolution, -1, 0, 0))
+    events.append((d.fs_start_time - resolution, 0, 1, d.fs_io_rate))
+    events.append((fs_end_time - resolution, 0, -1, -d.fs_io_rate))
+  events.sort(key=lambda e: e[0])
+  timeline = []
+  i = 0
+  tasks = downloads = 0
+  # Kept exact so adding and removing rates never leaves rounding residue
+  throughput = fractions.Fraction(0)
+  for cur_time in get_bucket_times(ds, resolution):
+    while i < len(events) and events[i][0] <= cur_time:
+      tasks += events[i][1]
+      downloads += events[i][2]
+      throughput += fractions.Fraction(events[i][3])
+      i += 1
+    timeline.append(
+        TimelinePoint(cur_time, tasks, downloads, float(throughput)))
+  return timeline
+
+
+def get_lane_values(pipelines, timeline, resolution):
+  # ^: before download, D: downloading, $: after download
+  cursors = [0] * len(pipelines)
+  for point in timeline:
+    cur_time = point.time
+    pvalues = []
+    for pi, pipeline in enumerate(pipelines):
+      j = cursors[pi]
+      while (j + 1 < len(pipeline) and
+             cur_time >= pipeline[j + 1].start_time - resolution):
+        j += 1
+      cursors[pi] = j
+      d = pipeline[j]
+      if not (d.start_time - resolution <= cur_time < d.end_time + resolution):
+        pvalues.append(" ")
+      elif cur_time < d.fs_start_time - resolution:
+        pvalues.append("^")
+      elif cur_time < d.fs_start_time + datetime.timedelta(
+          seconds=d.fs_exec_time) - resolution:
+        pvalues.append("D")
+      else:
+        pvalues.append("$")
+    yield pvalues
+
+
+def format_bucket_time(t, resolution):
+  if resolution.microseconds:
+    return "{0:%H:%M:%S.%f}".format(t)[:-3]
+  return "{0:%H:%M:%S}".format(t)
+
+
+def write_timeline_csv(timeline, path):
+  with open(path, "w", newline="") as f:
+    writer = csv.writer(f)
+    writer.writerow(TIMELINE_COLUMNS)
+    for p in timeline:
+      writer.writerow([
+          p.time.isoformat(), p.tasks, p.downloads,
+          "{0:.3f}".format(p.throughput)
+      ])
+
+
+def write_timeline_json(timeline, path):
+  with open(path, "w") as f:
+    json.dump([{
+        "time": p.time.isoformat(),
+        "tasks": p.tasks,
+        "downloads": p.downloads,
+        "throughput": round(p.throughput, 3),
+    } for p in timeline], f, indent=1)
+
+
+def get_phases(d):
+  # Returns the intro, map intro and outro seconds around the download
+  intro_elapsed = (d.map_start_time - d.start_time).total_seconds()
+  map_intro_elapsed = (d.fs_start_time - d.map_start_time).total_seconds()
+  outro_elapsed = (d.end_time -
+                   d.fs_start_time).total_seconds() - d.fs_exec_time
+  return intro_elapsed, map_intro_elapsed, outro_elapsed
+
+
+def get_download_segments(ds):
+  # Returns (start, end, downloads, aggregate fs_io_rate) between changes
+  events = []
+  for d in ds:
+    fs_end_time = d.fs_start_time + datetime.timedelta(seconds=d.fs_exec_time)
+    events.append((d.fs_start_time, 1, d.fs_io_rate))
+    events.append((fs_end_time, -1, -d.fs_io_rate))
+  events.sort(key=lambda e: e[0])
+  segments = []
+  downloads = 0
+  rate = fractions.Fraction(0)
+  for i, (t, dn, dr) in enumerate(events):
+    downloads += dn
+    rate += fractions.Fraction(dr)
+    if i + 1 < len(events) and events[i + 1][0] > t:
+      segments.append((t, events[i + 1][0], downloads, float(rate)))
+  return segments
+
+
+def get_task_concurrency(ds, segments):
+  # Time-weighted mean number of downloads over each task's own download
+  starts = [seg[0] for seg in segments]
+  cum = [0]
+  for start, end, downloads, _ in segments:
+    cum.append(cum[-1] + downloads * (end - start).total_seconds())
+
+  def integral(t):
+    k = bisect.bisect_right(starts, t) - 1
+    if k < 0:
+      return 0
+    start, end, downloads, _ = segments[k]
+    return cum[k] + downloads * (min(t, end) - start).total_seconds()
+
+  result = []
+  for d in ds:
+    if d.fs_exec_time <= 0:
+      k = bisect.bisect_right(starts, d.fs_start_time) - 1
+      result.append(segments[k][2] if k >= 0 else 1)
+      continue
+    fs_end_time = d.fs_start_time + datetime.timedelta(seconds=d.fs_exec_time)
+    mean = (integral(fs_end_time) -
+            integral(d.fs_start_time)) / d.fs_exec_time
+    result.append(max(1, int(round(mean))))
+  return result
+
+
+def weighted_percentile(pairs, percentile):
+  pairs = sorted(pairs)
+  total = sum(w for _, w in pairs)
+  acc = 0
+  for value, weight in pairs:
+    acc += weight
+    if acc >= total * percentile / 100:
+      return value
+  return pairs[-1][0]
+
+
+def usl(n, lam, sigma, kappa):
+  return lam * n / (1 + sigma * (n - 1) + kappa * n * (n - 1))
+
+
+def fit_usl(points):
+  # Fits the Universal Scalability Law to (N, throughput, weight) points.
+  # lambda is solved in closed form for a sigma and kappa found by a zooming
+  # grid search. Returns (lambda, sigma, kappa, r2), None below 3 levels.
+  if len(points) < 3:
+    return None
+
+  def solve(sigma, kappa):
+    fs = [(usl(n, 1, sigma, kappa), x, w) for n, x, w in points]
+    lam = (sum(f * x * w for f, x, w in fs) /
+           max(sum(f * f * w for f, _, w in fs), 1e-12))
+    sse = sum(w * (x - lam * f)**2 for f, x, w in fs)
+    return sse, lam
+
+  sigma_range = (0.0, 1.0)
+  kappa_range = (0.0, 0.1)
+  best = None
+  for _ in range(USL_FIT_ROUNDS):
+    for i in range(USL_GRID_SIZE + 1):
+      sigma = sigma_range[0] + (
+          sigma_range[1] - sigma_range[0]) * i / USL_GRID_SIZE
+      for j in range(USL_GRID_SIZE + 1):
+        kappa = kappa_range[0] + (
+            kappa_range[1] - kappa_range[0]) * j / USL_GRID_SIZE
+        sse, lam = solve(sigma, kappa)
+        if best is None or sse < best[0]:
+          best = (sse, lam, sigma, kappa)
+    sigma_step = (sigma_range[1] - sigma_range[0]) / USL_GRID_SIZE
+    kappa_step = (kappa_range[1] - kappa_range[0]) / USL_GRID_SIZE
+    sigma_range = (max(0.0, best[2] - sigma_step), best[2] + sigma_step)
+    kappa_range = (max(0.0, best[3] - kappa_step), best[3] + kappa_step)
+  sse, lam, sigma, kappa = best
+  total_w = sum(w for _, _, w in points)
+  mean = sum(x * w for _, x, w in points) / total_w
+  sst = sum(w * (x - mean)**2 for _, x, w in points)
+  r2 = 1 - sse / sst if sst > 0 else 1.0
+  return lam, sigma, kappa, r2
+
+
+def print_scaling_report(ds):
+  segments = get_download_segments(ds)
+  concurrency = get_task_concurrency(ds, segments)
+  tasks = collections.defaultdict(list)
+  for d, n in zip(ds, concurrency):
+    tasks[n].append(d)
+  aggregates = collections.defaultdict(list)
+  for start, end, downloads, rate in segments:
+    if downloads > 0:
+      aggregates[downloads].append((rate, (end - start).total_seconds()))
+
+  points = []
+  for n, pairs in sorted(aggregates.items()):
+    elapsed = sum(w for _, w in pairs)
+    if elapsed > 0:
+      points.append((n, sum(r * w for r, w in pairs) / elapsed, elapsed))
+  fit = fit_usl(points)
+  means = {n: x for n, x, _ in points}
+
+  pcols = ["p" + str(p) for p in SCALING_PERCENTILES]
+  print("\t".join(["concurrency", "elapsed", "tasks"] +
+                  ["task_" + c for c in pcols] +
+                  ["aggregate_" + c for c in pcols] +
+                  ["aggregate_mean", "usl", "intro_p50", "map_intro_p50",
+                   "outro_p50"]))
+  for n in sorted(set(aggregates) | set(tasks)):
+    pairs = aggregates.get(n, [])
+    values = ["{0}".format(n), "{0:.2f}".format(sum(w for _, w in pairs)),
+              "{0}".format(len(tasks[n]))]
+    rates = [(d.fs_io_rate, 1) for d in tasks[n]]
+    phases = [get_phases(d) for d in tasks[n]]
+    for data in (rates, pairs):
+      values += [
+          "{0:.2f}".format(weighted_percentile(data, p)) if data else ""
+          for p in SCALING_PERCENTILES
+      ]
+    values.append("{0:.2f}".format(means[n]) if n in means else "")
+    values.append("{0:.2f}".format(usl(n, *fit[:3])) if fit else "")
+    for i in range(3):
+      values.append("{0:.2f}".format(
+          weighted_percentile([(ph[i], 1) for ph in phases], 50)
+      ) if phases else "")
+    print("\t".join(values))
+
+  print()
+  print("\t".join(["phase"] + pcols + ["mean"]))
+  for i, name in enumerate(["intro", "map_intro", "outro"]):
+    data = [(get_phases(d)[i], 1) for d in ds]
+    print("\t".join([name] + [
+        "{0:.2f}".format(weighted_percentile(data, p))
+        for p in SCALING_PERCENTILES
+    ] + ["{0:.2f}".format(sum(v for v, _ in data) / len(data))]))
+
+  print()
+  if not fit:
+    print("usl: not enough concurrency levels to fit")
+    return
+  lam, sigma, kappa, r2 = fit
+  line = ("usl: lambda={0:.2f} MB/s sigma={1:.4f} kappa={2:.6f} "
+          "r2={3:.3f}".format(lam, sigma, kappa, r2))
+  if kappa > 0:
+    # Beyond N* extra mappers lower aggregate throughput
+    peak = ((1 - sigma) / kappa)**0.5
+    line += " peak_concurrency={0:.1f} peak_throughput={1:.2f} MB/s".format(
+        peak, usl(peak, lam, sigma, kappa))
+  print(line)
+
+
 def run(args):
-  ds = []
-  for p in os.walk(args.input):
-    if "syslog" in p[2]:
-      d = analyze_clog(p[0])
-      if d.fs_start_time:
-        ds.append(d)
-  ds = list(sorted(ds, key=lambda x: x.start_time))
+  cache = DigestCache(args.cache)
+  last_ds = None
+  while True:
+    ds = analyze_clogs(args.input, args.jobs, cache)
+    cache.save()
+    ds = list(sorted(ds, key=lambda x: x.start_time))
+    if ds and ds != last_ds:
+      if last_ds is not None:
+        print()
+      if args.report == "scaling":
+        print_scaling_report(ds)
+      else:
+        print_report(args, ds)
+      sys.stdout.flush()
+      last_ds = ds
+    if not args.follow:
+      break
+    time.sleep(args.interval)
+
+
+def print_report(args, ds):
   print("\t".join([
       "time", "total_elapsed", "intro_elapsed", "map_intro_elapsed",
       "fs_elapsed", "outro_elapsed", "fs_io_rate (MB/s)"
   ]))
   for d in ds:
     total_elapsed = (d.end_time - d.start_time).total_seconds()
-    intro_elapsed = (d.map_start_time - d.start_time).total_seconds()
-    map_intro_elapsed = (d.fs_start_time - d.map_start_time).total_seconds()
-    outro_elapsed = (d.end_time -
-                     d.fs_start_time).total_seconds() - d.fs_exec_time
+    intro_elapsed, map_intro_elapsed, outro_elapsed = get_phases(d)
     print("{0:%H:%M:%S}\t{1:.2f}\t{2:.2f}\t{3:.2f}\t{4:.2f}\t{5:.2f}\t{6:.2f}"
           .format(d.start_time, total_elapsed, intro_elapsed, map_intro_elapsed,
                   d.fs_exec_time, outro_elapsed, d.fs_io_rate))
   print()
-  one_sec = datetime.timedelta(seconds=1)
+  resolution = datetime.timedelta(seconds=args.resolution)
   pipelines = build_pipelines(ds)
+  timeline = build_timeline(ds, resolution)
+  if args.timeline_csv:
+    write_timeline_csv(timeline, args.timeline_csv)
+  if args.timeline_json:
+    write_timeline_json(timeline, args.timeline_json)
   print("\t".join([
       "time",
   ] + ["p" + str(i) for i in range(len(pipelines))] + [
       "downloads",
       "throughput (MB/s)",
   ]))
-  min_time = min(d.start_time for d in ds).replace(microsecond=0)
-  max_time = max(d.end_time for d in ds).replace(microsecond=0)
-  cur_time = min_time
-  while cur_time <= max_time:
-    pvalues = []
-    x = 0
-    s = 0
-    for pipeline in pipelines:
-      d = None
-      for task in pipeline:
-        if cur_time >= task.start_time - one_sec and cur_time < task.end_time + one_sec:
-          d = task
-      if d:
-        if cur_time < d.fs_start_time - one_sec:
-          pvalues.append("^")
-        elif cur_time < d.fs_start_time + datetime.timedelta(
-            seconds=d.fs_exec_time) - one_sec:
-          pvalues.append("D")
-          x += d.fs_io_rate
-          s += 1
-        else:
-          pvalues.append("$")
-      else:
-        pvalues.append(" ")
-    print("{0:%H:%M:%S}\t{1}\t{2}\t{3:.2f}".format(cur_time, "\t".join(pvalues), s, x))
-    cur_time = cur_time + datetime.timedelta(seconds=1)
-
+  lane_values = get_lane_values(pipelines, timeline, resolution)
+  for point, pvalues in zip(timeline, lane_values):
+    print("{0}\t{1}\t{2}\t{3:.2f}".format(
+        format_bucket_time(point.time, resolution), "\t".join(pvalues),
+        point.downloads, point.throughput))
 
 
 def main():
   parser = argparse.ArgumentParser(description='Runs command')
   parser.add_argument('-i', '--input', help="The path of input directory")
+  parser.add_argument(
+      '-j',
+      '--jobs',
+      type=int,
+      default=None,
+      help="Number of parser processes (default: CPU count)")
+  parser.add_argument(
+      '--resolution',
+      type=float,
+      default=1,
+      help="Timeline bucket size in seconds")
+  parser.add_argument(
+      '--timeline_csv', help="Write concurrency and throughput series as CSV")
+  parser.add_argument(
+      '--timeline_json', help="Write concurrency and throughput series as JSON")
+  parser.add_argument(
+      '--report',
+      choices=["timeline", "scaling"],
+      default="timeline",
+      help="Per-task rows and lane timeline, or throughput vs concurrency")
+  parser.add_argument(
+      '--cache',
+      help="JSON-lines digest cache; only new or changed containers are parsed")
+  parser.add_argument(
+      '--follow',
+      action="store_true",
+      help="Keep watching the input and reprint as containers finish")
+  parser.add_argument(
+      '--interval',
+      type=float,
+      default=10,
+      help="Seconds between scans with --follow")
   args = parser.parse_args()
   run(args)
 
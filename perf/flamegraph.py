@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import html
+import os
+import re
+import subprocess
+import sys
+import zlib
+
+PERF_DATA_MAGIC = b"PERFILE"
+SVG_WIDTH = 1200
+SVG_FRAME_HEIGHT = 16
+SVG_FONT_SIZE = 12
+SVG_FONT_WIDTH = 0.59
+SVG_XPAD = 10
+SVG_YPAD_TOP = SVG_FONT_SIZE * 3
+SVG_YPAD_BOTTOM = SVG_FONT_SIZE * 2 + 10
+SVG_MIN_WIDTH = 0.1
+
+RE_SAMPLE_HEADER = re.compile(r"^(\S.*?)\s+(\d+)(?:/(\d+))?\s")
+RE_STACK_FRAME = re.compile(r"^\s*([0-9a-fA-F]+)\s+(.*?)\s*\(([^()]*)\)\s*$")
+RE_SYMBOL_OFFSET = re.compile(r"\+0x[0-9a-fA-F]+$")
+# perf-map-agent writes class names in JVM descriptor form: Lpkg/Cls;::method
+RE_PERF_MAP_JAVA = re.compile(r"^L([\w/$]+);::(.+)$")
+RE_JAVA_LAMBDA = re.compile(r"\$\$Lambda\$\d+/(?:0x)?[0-9a-fA-F]+")
+RE_PERF_MAP_FILE = re.compile(r"/perf-\d+\.map$")
+
+
+def clean_frame(symbol, module, java):
+  symbol = RE_SYMBOL_OFFSET.sub("", symbol)
+  if symbol in ("", "[unknown]"):
+    if module and module != "[unknown]":
+      symbol = "[{0}]".format(os.path.basename(module))
+    else:
+      symbol = "[unknown]"
+  if java:
+    m = RE_PERF_MAP_JAVA.match(symbol)
+    if m:
+      symbol = "{0}::{1}".format(m.group(1), m.group(2))
+    symbol = RE_JAVA_LAMBDA.sub("$$Lambda$", symbol)
+  symbol = symbol.replace(";", ":")
+  if module == "[kernel.kallsyms]":
+    symbol += "_[k]"
+  elif java and RE_PERF_MAP_FILE.search(module):
+    symbol += "_[j]"
+  return symbol
+
+
+def collapse_perf_script(lines, java=False, pid=False, tid=False):
+  # Folds perf script lines into collapsed stack counts as they arrive
+  stacks = collections.Counter()
+  head = None
+  frames = []
+  for line in lines:
+    if head is None:
+      m = RE_SAMPLE_HEADER.match(line)
+      if m:
+        comm = m.group(1).replace(" ", "_")
+        if tid and m.group(3):
+          comm = "{0}-{1}/{2}".format(comm, m.group(2), m.group(3))
+        elif pid or tid:
+          comm = "{0}-{1}".format(comm, m.group(2))
+        head = comm
+        frames = []
+      continue
+    if not line.strip():
+      frames.append(head)
+      stacks[";".join(reversed(frames))] += 1
+      head = None
+      continue
+    m = RE_STACK_FRAME.match(line)
+    if m:
+      frames.append(clean_frame(m.group(2), m.group(3), java))
+  if head is not None:
+    frames.append(head)
+    stacks[";".join(reversed(frames))] += 1
+  return stacks
+
+
+def is_perf_data(path):
+  if path == "-":
+    return False
+  with open(path, "rb") as f:
+    return f.read(len(PERF_DATA_MAGIC)) == PERF_DATA_MAGIC
+
+
+def collapse_perf_data(path, java=False, pid=False, tid=False):
+  process = subprocess.Popen(["perf", "script", "-i", path],
+                             stdout=subprocess.PIPE,
+                             universal_newlines=True,
+                             errors="replace")
+  stacks = collapse_perf_script(process.stdout, java, pid, tid)
+  process.wait()
+  return stacks
+
+
+def read_collapsed(f):
+  stacks = collections.Counter()
+  for line in f:
+    stack, _, count = line.rstrip("\n").rpartition(" ")
+    if stack:
+      stacks[stack] += int(count)
+  return stacks
+
+
+def write_collapsed(stacks, f):
+  for stack, count in sorted(stacks.items()):
+    f.write("{0} {1}\n".format(stack, count))
+
+
+def load_stacks(path, java=False):
+  # Reads collapsed stacks from a perf.data, a collapsed file or stdin
+  if is_perf_data(path):
+    return collapse_perf_data(path, java)
+  if path == "-":
+    return read_collapsed(sys.stdin)
+  with open(path, "rt") as f:
+    return read_collapsed(f)
+
+
+def build_tree(stacks):
+  root = [0, {}]
+  for stack, count in stacks.items():
+    node = root
+    node[0] += count
+    for frame in stack.split(";"):
+      node = node[1].setdefault(frame, [0, {}])
+      node[0] += count
+  return root
+
+
+def frame_color(name, palette):
+  h = zlib.crc32(name.encode())
+  v1, v2, v3 = (h & 0xff) / 255, ((h >> 8) & 0xff) / 255, (h >> 16 & 0xff) / 255
+  if palette == "java":
+    if name.endswith("_[j]") or ("/" in name and "::" in name):
+      return (50 + int(60 * v3), 200 + int(55 * v3), 50 + int(60 * v3))
+    if name.endswith("_[i]"):
+      return (80 + int(60 * v3), 200 + int(55 * v3), 200 + int(55 * v3))
+    if name.endswith("_[k]"):
+      return (200 + int(55 * v3), 140 + int(60 * v3), 0)
+    if "::" in name:
+      return (175 + int(55 * v3), 175 + int(55 * v3), 50 + int(20 * v3))
+  return (205 + int(50 * v3), int(230 * v1), int(55 * v2))
+
+
+def diff_color(delta, max_delta):
+  if max_delta <= 0 or delta == 0:
+    return (250, 250, 250)
+  x = 250 - int(210 * min(1.0, abs(delta) / max_delta))
+  return (250, x, x) if delta > 0 else (x, x, 250)
+
+
+def layout(root, base_root, min_count):
+  # Yields (depth, x, name, node, base_node) in sample units, parents first
+  todo = [(0, 0, "all", root, base_root)]
+  while todo:
+    depth, x, name, node, base = todo.pop()
+    yield depth, x, name, node, base
+    child_x = x
+    for child_name in sorted(node[1]):
+      child = node[1][child_name]
+      if child[0] >= min_count:
+        child_base = base[1].get(child_name) if base else None
+        todo.append((depth + 1, child_x, child_name, child, child_base))
+      child_x += child[0]
+
+
+def render_svg(stacks, f, title, palette="hot", base_stacks=None):
+  # With base_stacks, frames are colored by the change in their share of
+  # samples: red grew, blue shrank
+  root = build_tree(stacks)
+  base_root = build_tree(base_stacks) if base_stacks is not None else None
+  total = max(root[0], 1)
+  scale = (SVG_WIDTH - 2 * SVG_XPAD) / total
+  min_count = SVG_MIN_WIDTH / scale
+  frames = list(layout(root, base_root, min_count))
+  max_depth = max(depth for depth, _, _, _, _ in frames)
+  height = ((max_depth + 1) * SVG_FRAME_HEIGHT + SVG_YPAD_TOP +
+            SVG_YPAD_BOTTOM)
+
+  deltas = {}
+  max_delta = 0
+  if base_root is not None:
+    base_total = max(base_root[0], 1)
+    for i, (_, _, _, node, base) in enumerate(frames):
+      delta = node[0] / total - (base[0] if base else 0) / base_total
+      deltas[i] = delta
+      max_delta = max(max_delta, abs(delta))
+
+  f.write('<?xml version="1.0" standalone="no"?>\n'
+          '<svg version="1.1" width="{0}" height="{1}" '
+          'xmlns="http://www.w3.org/2000/svg">\n'.format(SVG_WIDTH, height))
+  f.write('<rect x="0" y="0" width="{0}" height="{1}" fill="#f8f8f8"/>\n'
+          '<g font-family="Verdana" font-size="{2}">\n'.format(
+              SVG_WIDTH, height, SVG_FONT_SIZE))
+  f.write('<text x="{0}" y="{1}" text-anchor="middle" font-size="{2}">'
+          '{3}</text>\n'.format(SVG_WIDTH // 2, SVG_FONT_SIZE * 2,
+                                SVG_FONT_SIZE + 5, html.escape(title)))
+  for i, (depth, x, name, node, base) in enumerate(frames):
+    px = SVG_XPAD + x * scale
+    width = node[0] * scale
+    y = height - SVG_YPAD_BOTTOM - (depth + 1) * SVG_FRAME_HEIGHT
+    info = "{0} ({1} samples, {2:.2f}%)".format(name, node[0],
+                                                100 * node[0] / total)
+    if base_root is not None:
+      color = diff_color(deltas[i], max_delta)
+      info += ", base {0} samples, {1:+.2f}%".format(base[0] if base else 0,
+                                                     100 * deltas[i])
+    else:
+      color = frame_color(name, palette)
+    f.write('<g><title>{0}</title><rect x="{1:.1f}" y="{2}" width="{3:.1f}" '
+            'height="{4}" fill="rgb({5},{6},{7})" rx="2"/>'.format(
+                html.escape(info), px, y, width, SVG_FRAME_HEIGHT - 1,
+                *color))
+    chars = int(width / (SVG_FONT_SIZE * SVG_FONT_WIDTH))
+    if chars >= 3:
+      text = name if len(name) <= chars else name[:chars - 2] + ".."
+      f.write('<text x="{0:.1f}" y="{1}">{2}</text>'.format(
+          px + 3, y + SVG_FRAME_HEIGHT - 4, html.escape(text)))
+    f.write('</g>\n')
+  f.write('</g>\n</svg>\n')
+
+
+def collapse_main(args):
+  if args.input == "-":
+    stacks = collapse_perf_script(sys.stdin, args.java, args.pid, args.tid)
+  else:
+    stacks = collapse_perf_data(args.input, args.java, args.pid, args.tid)
+  if args.output == "-":
+    write_collapsed(stacks, sys.stdout)
+  else:
+    with open(args.output, "wt") as f:
+      write_collapsed(stacks, f)
+
+
+def svg_main(args):
+  stacks = load_stacks(args.input, args.java)
+  if args.collapsed:
+    with open(args.collapsed, "wt") as f:
+      write_collapsed(stacks, f)
+  palette = "java" if args.java else "hot"
+  with open(args.output, "wt") as f:
+    render_svg(stacks, f, args.title or "Flame Graph", palette)
+
+
+def diff_main(args):
+  base = load_stacks(args.base, args.java)
+  stacks = load_stacks(args.input, args.java)
+  title = args.title or "Differential Flame Graph: {0} vs {1}".format(
+      args.input, args.base)
+  with open(args.output, "wt") as f:
+    render_svg(stacks, f, title, base_stacks=base)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+      description='Collapsed stacks and flamegraphs')
+  subparsers = parser.add_subparsers(dest="command", required=True)
+
+  collapse_parser = subparsers.add_parser(
+      "collapse", help="Fold perf script output into collapsed stacks")
+  collapse_parser.add_argument(
+      "-i", "--input", default="perf.data",
+      help="perf.data to run perf script on, or - for perf script text")
+  collapse_parser.add_argument("-o", "--output", default="-")
+  collapse_parser.add_argument("--pid", action="store_true",
+                               help="Include PID with process names")
+  collapse_parser.add_argument("--tid", action="store_true",
+                               help="Include PID/TID with process names")
+  collapse_parser.set_defaults(func=collapse_main)
+
+  svg_parser = subparsers.add_parser("svg", help="Render a flamegraph")
+  svg_parser.add_argument("input", help="perf.data or collapsed stacks")
+  svg_parser.add_argument("-o", "--output", required=True)
+  svg_parser.add_argument("--collapsed",
+                          help="Also write the collapsed stacks here")
+  svg_parser.set_defaults(func=svg_main)
+
+  diff_parser = subparsers.add_parser(
+      "diff", help="Render a differential flamegraph of input against base")
+  diff_parser.add_argument("base", help="perf.data or collapsed stacks")
+  diff_parser.add_argument("input", help="perf.data or collapsed stacks")
+  diff_parser.add_argument("-o", "--output", required=True)
+  diff_parser.set_defaults(func=diff_main)
+
+  for p in (collapse_parser, svg_parser, diff_parser):
+    p.add_argument("--java", action="store_true",
+                   help="Clean up perf-map-agent frames and mark JIT code")
+  for p in (svg_parser, diff_parser):
+    p.add_argument("--title")
+
+  args = parser.parse_args()
+  args.func(args)
+
+
+if __name__ == "__main__":
+  main()
@@ -12,20 +12,25 @@ if [ -z "$PERF_REPORT_OUTPUT" ]; then
   PERF_REPORT_OUTPUT=${PERF_OUTPUT_PATH%.data}.txt
 fi
 
-STACKS=$PERF_JAVA_TMP/out-$PERF_TARGET_PID.stacks
 COLLAPSED=$PERF_JAVA_TMP/out-$PERF_TARGET_PID.collapsed
-
-if [ ! -x "$FLAMEGRAPH_DIR/stackcollapse-perf.pl" ]; then
-  echo "FlameGraph executable not found at '$FLAMEGRAPH_DIR/stackcollapse-perf.pl'. Please set FLAMEGRAPH_DIR to the root of the clone of https://github.com/brendangregg/FlameGraph."
-  exit
-fi
+FLAMEGRAPH=$(dirname "$0")/flamegraph.py
 
 if [ -z "$PERF_FLAME_OUTPUT" ]; then
   PERF_FLAME_OUTPUT=${PERF_OUTPUT_PATH%.data}-flamegraph.svg
 fi
 
-if [ -z "$PERF_FLAME_OPTS" ]; then
-  PERF_FLAME_OPTS="--color=java"
+# PERF_FLAME_OPTS and PERF_COLLAPSE_OPTS held options of the FlameGraph Perl
+# scripts (flamegraph.pl, stackcollapse-perf.pl), which flamegraph.py does not
+# take. They are ignored now; set PERF_FLAME_TITLE for the graph title. Java
+# coloring (formerly --color=java) is always on through --java.
+for opts in PERF_FLAME_OPTS PERF_COLLAPSE_OPTS; do
+  if [ -n "${!opts}" ]; then
+    echo "$opts is no longer supported and is ignored: ${!opts}" >&2
+  fi
+done
+
+if [ -z "$PERF_FLAME_TITLE" ]; then
+  PERF_FLAME_TITLE="Flame Graph: $PERF_OUTPUT_PATH"
 fi
 
 # Create symbol map using https://github.com/jvm-profiling-tools/perf-map-agent
@@ -34,6 +39,10 @@ $PERF_MAP_DIR/bin/create-java-perf-map.sh $PERF_TARGET_PID "$PERF_MAP_OPTIONS"
 # Create a report
 perf report -i $PERF_OUTPUT_PATH --stdio --no-children --header > $PERF_REPORT_OUTPUT
 
-# Create a flamegraph
-perf script -i $PERF_OUTPUT_PATH > $STACKS
-$FLAMEGRAPH_DIR/stackcollapse-perf.pl $PERF_COLLAPSE_OPTS $STACKS | tee $COLLAPSED | $FLAMEGRAPH_DIR/flamegraph.pl $PERF_FLAME_OPTS > $PERF_FLAME_OUTPUT
+# Create a flamegraph, folding perf script output as it streams
+$FLAMEGRAPH svg --java --title "$PERF_FLAME_TITLE" --collapsed $COLLAPSED -o $PERF_FLAME_OUTPUT $PERF_OUTPUT_PATH
+
+# Diff against a previous run (e.g. HTTP vs gRPC) when a base is given
+if [ -n "$PERF_FLAME_DIFF_BASE" ]; then
+  $FLAMEGRAPH diff --java -o ${PERF_FLAME_OUTPUT%.svg}-diff.svg $PERF_FLAME_DIFF_BASE $COLLAPSED
+fi
@@ -1,65 +1,563 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import datetime
+import glob
 import locale
-import queue
+import re
+import select
+import selectors
 import shlex
+import shutil
 import signal
+import statistics
 import subprocess
 import os
+import queue
 import sys
+import tempfile
 import threading
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import flamegraph
+
+PERF_ACK_TIMEOUT = 5
+PERF_SWITCH_TIMEOUT = 10
+READ_CHUNK_SIZE = 1 << 16
+READ_TIMEOUT = 0.1
+TARGET_POLL_INTERVAL = 0.05
+# Without a start trigger, matched threads must stay the same this long
+TARGET_STABLE_TIME = 1.0
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+TELEMETRY_COLUMNS = [
+    "time", "window", "pid", "tid", "comm", "cpu_user", "cpu_sys", "rss_kb",
+    "threads", "read_bytes", "write_bytes", "ctx_vol", "ctx_invol"
+]
+
+
+@dataclass
+class CaptureWindow:
+  window: int
+  start: datetime.datetime
+  stop: datetime.datetime
+  output: str
+  trigger_latency: Optional[float] = None
+
+
+class OutputReader:
+  # Non-blocking reader of the command's stdout. Hands out whole lines in
+  # chunks and copies everything to the console or the log as it arrives.
+  def __init__(self, stream, log_path):
+    self.fd = stream.fileno()
+    os.set_blocking(self.fd, False)
+    self.selector = selectors.DefaultSelector()
+    self.selector.register(self.fd, selectors.EVENT_READ)
+    self.log = open(log_path, "wb") if log_path else None
+    self.pending = b""
+
+  def read(self, timeout):
+    # Returns (lines, read_time); lines is None on timeout, b"" on EOF
+    if not self.selector.select(timeout):
+      return None, None
+    try:
+      data = os.read(self.fd, READ_CHUNK_SIZE)
+    except BlockingIOError:
+      return None, None
+    read_time = time.perf_counter()
+    if not data:
+      lines, self.pending = self.pending, b""
+      return lines, read_time
+    self.passthrough(data)
+    end = data.rfind(b"\n") + 1
+    if end == 0:
+      self.pending += data
+      return None, None
+    lines = self.pending + data[:end]
+    self.pending = data[end:]
+    return lines, read_time
 
+  def passthrough(self, data):
+    if self.log:
+      self.log.write(data)
+    else:
+      sys.stdout.flush()
+      sys.stdout.buffer.write(data)
+      sys.stdout.buffer.flush()
 
-def enqueue_output(out, que):
-  for line in iter(out.readline, b''):
-    que.put(line)
-  out.close()
+  def close(self):
+    self.selector.close()
+    if self.log:
+      self.log.close()
 
 
-def run_command(cmd_argv, que):
+def run_command(cmd_argv):
   print("*** Start commands: ")
   print("- Arguments: ", cmd_argv)
-  process = subprocess.Popen(
-      cmd_argv, stdout=subprocess.PIPE, bufsize=1, close_fds=1)
+  process = subprocess.Popen(cmd_argv, stdout=subprocess.PIPE, close_fds=1)
   print("- PID={0}".format(process.pid))
-  thread = threading.Thread(target=enqueue_output, args=(process.stdout, que))
-  thread.daemon = True
-  thread.start()
   return process
 
 
-def run_perf(perf_argv, pid, on_start_script):
-  args = ["perf", "record", "-p", str(pid)] + perf_argv
+def read_proc_file(path):
+  try:
+    with open(path, "rb") as f:
+      return f.read().decode(errors="replace")
+  except OSError:
+    return None
+
+
+def get_descendants(pid):
+  children = collections.defaultdict(list)
+  for entry in os.listdir("/proc"):
+    if entry.isdigit():
+      stat = read_proc_file("/proc/{0}/stat".format(entry))
+      if stat:
+        # The field after the ")" of comm is state, then ppid
+        ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        children[ppid].append(int(entry))
+  result = []
+  todo = [pid]
+  while todo:
+    p = todo.pop(0)
+    result.append(p)
+    todo.extend(sorted(children[p]))
+  return result
+
+
+class TargetResolver:
+  # Picks the processes and threads perf attaches to under the command. A
+  # tree relies on perf's inherit for later children, so no --no-inherit.
+  def __init__(self, root_pid, tree, comm, cmdline, threads):
+    self.root_pid = root_pid
+    self.tree = tree
+    self.comm = re.compile(comm) if comm else None
+    self.cmdline = re.compile(cmdline) if cmdline else None
+    self.threads = re.compile(threads) if threads else None
+
+  def resolve(self):
+    # Returns (pid, perf target args) or None if nothing matches yet
+    pids = [self.root_pid]
+    if self.tree or self.comm or self.cmdline:
+      pids = get_descendants(self.root_pid)
+    if self.comm or self.cmdline:
+      pids = [p for p in pids if self._match_process(p)][:1]
+      if not pids:
+        return None
+    if self.threads:
+      tids = []
+      for p in pids:
+        try:
+          tasks = sorted(os.listdir("/proc/{0}/task".format(p)), key=int)
+        except OSError:
+          continue
+        for tid in tasks:
+          comm = read_proc_file("/proc/{0}/task/{1}/comm".format(p, tid))
+          if comm and self.threads.search(comm.rstrip("\n")):
+            tids.append(tid)
+      if not tids:
+        return None
+      return pids[0], ["-t", ",".join(tids)]
+    return pids[0], ["-p", ",".join(str(p) for p in pids)]
+
+  def _match_process(self, pid):
+    if self.comm:
+      comm = read_proc_file("/proc/{0}/comm".format(pid))
+      if comm is None or not self.comm.search(comm.rstrip("\n")):
+        return False
+    if self.cmdline:
+      cmdline = read_proc_file("/proc/{0}/cmdline".format(pid))
+      if cmdline is None:
+        return False
+      if not self.cmdline.search(cmdline.rstrip("\0").replace("\0", " ")):
+        return False
+    return True
+
+
+def parse_proc_keys(text):
+  # "Key: value" lines of /proc/PID/{status,io}
+  values = {}
+  for line in (text or "").splitlines():
+    key, _, value = line.partition(":")
+    values[key] = value.split()[0] if value.split() else ""
+  return values
+
+
+def read_task(path):
+  # Returns (comm, user sec, sys sec, status) of a /proc process or task
+  stat = read_proc_file(path + "/stat")
+  status = read_proc_file(path + "/status")
+  if not stat or not status:
+    return None
+  comm = stat[stat.index("(") + 1:stat.rindex(")")]
+  fields = stat[stat.rindex(")") + 2:].split()
+  return (comm, int(fields[11]) / CLOCK_TICKS, int(fields[12]) / CLOCK_TICKS,
+          parse_proc_keys(status))
+
+
+class ProcSampler:
+  # Writes /proc stats of the target as TSV rows per process (tid empty)
+  # and thread, tagged with the open window (0 while paused). CPU times, I/O
+  # bytes and context switches are cumulative.
+  def __init__(self, path, rate, get_pids, get_window, threads=None):
+    self.path = path
+    self.interval = 1.0 / rate
+    self.get_pids = get_pids
+    self.get_window = get_window
+    self.threads = threads
+    self.f = open(path, "wt")
+    self.f.write("\t".join(TELEMETRY_COLUMNS) + "\n")
+    self.stop_event = threading.Event()
+    self.thread = threading.Thread(target=self._loop)
+    self.thread.daemon = True
+
+  def start(self):
+    self.thread.start()
+
+  def stop(self):
+    self.stop_event.set()
+    self.thread.join()
+    self.f.close()
+
+  def _loop(self):
+    next_time = time.monotonic()
+    while not self.stop_event.is_set():
+      self.sample()
+      next_time += self.interval
+      self.stop_event.wait(max(0, next_time - time.monotonic()))
+
+  def _write(self, *values):
+    self.f.write("\t".join("" if v is None else str(v) for v in values))
+    self.f.write("\n")
+
+  def sample(self):
+    now = "{0:.3f}".format(time.time())
+    window = self.get_window()
+    for pid in self.get_pids():
+      base = "/proc/{0}".format(pid)
+      task = read_task(base)
+      if task is None:
+        continue
+      comm, user, sys_, status = task
+      io = parse_proc_keys(read_proc_file(base + "/io"))
+      self._write(now, window, pid, None, comm, "{0:.2f}".format(user),
+                  "{0:.2f}".format(sys_), status.get("VmRSS"),
+                  status.get("Threads"), io.get("read_bytes"),
+                  io.get("write_bytes"),
+                  status.get("voluntary_ctxt_switches"),
+                  status.get("nonvoluntary_ctxt_switches"))
+      try:
+        tids = os.listdir(base + "/task")
+      except OSError:
+        continue
+      for tid in sorted(tids, key=int):
+        task = read_task("{0}/task/{1}".format(base, tid))
+        if task is None:
+          continue
+        comm, user, sys_, status = task
+        if self.threads and not self.threads.search(comm):
+          continue
+        self._write(now, window, pid, tid, comm, "{0:.2f}".format(user),
+                    "{0:.2f}".format(sys_), None, None, None, None,
+                    status.get("voluntary_ctxt_switches"),
+                    status.get("nonvoluntary_ctxt_switches"))
+    # Flushed every sample so per-window --onstop scripts see it so far
+    self.f.flush()
+
+
+def compile_triggers(patterns):
+  # Triggers are searched in chunks of many lines, so ^ and $ anchor at lines
+  return [re.compile(p.encode(), re.MULTILINE) for p in patterns or []]
+
+
+def find_trigger(triggers, data, pos):
+  first = None
+  for trigger in triggers:
+    m = trigger.search(data, pos)
+    if m and (first is None or m.start() < first.start()):
+      first = m
+  return first
+
+
+def get_trigger_env(line, m):
+  env = {'PERF_TRIGGER_LINE': line}
+  for i, group in enumerate(m.groups(), 1):
+    if group is not None:
+      env['PERF_TRIGGER_{0}'.format(i)] = group.decode(errors="replace")
+  for name, group in m.groupdict().items():
+    if group is not None:
+      env['PERF_TRIGGER_' + name.upper()] = group.decode(errors="replace")
+  return env
+
+
+def run_on_start_script(on_start_script, pid, extra_env=None):
+  print("*** Run on_start_script:")
+  script_args = shlex.split(on_start_script)
+  print("- Arguments: ", script_args)
+  env = os.environ.copy()
+  env['PERF_TARGET_PID'] = str(pid)
+  env.update(extra_env or {})
+  script_proc = subprocess.run(script_args, env=env)
+  print("- ReturnCode: ", script_proc.returncode)
+
+
+def run_perf(perf_argv, pid, on_start_script, extra_env=None,
+             target_args=None):
+  args = ["perf", "record"] + (target_args or ["-p", str(pid)]) + perf_argv
   print("*** Start perf: ")
   print("- Arguments: ", args)
   process = subprocess.Popen(args)
   print("- PID={0}".format(process.pid))
   if on_start_script:
-    print("*** Run on_start_script:")
-    script_args = shlex.split(on_start_script)
-    print("- Arguments: ", script_args)
-    env = os.environ.copy()
-    env['PERF_TARGET_PID'] = str(pid)
-    script_proc = subprocess.run(script_args, env=env)
-    print("- ReturnCode: ", script_proc.returncode)
-
+    run_on_start_script(on_start_script, pid, extra_env)
   return process
 
 
-def stop_perf(perf_process, on_stop_script, pid, perf_output):
+def run_on_stop_script(on_stop_script, pid, perf_output, extra_env=None):
+  print("*** Run on_stop_script:")
+  script_args = shlex.split(on_stop_script)
+  print("- Arguments: ", script_args)
+  env = os.environ.copy()
+  env['PERF_TARGET_PID'] = str(pid)
+  env['PERF_OUTPUT_PATH'] = perf_output
+  env.update(extra_env or {})
+  script_proc = subprocess.run(script_args, env=env)
+  print("- ReturnCode: ", script_proc.returncode)
+
+
+def stop_perf(perf_process, on_stop_script, pid, perf_output, extra_env=None):
   print("*** Stop perf: ")
   perf_process.send_signal(signal.SIGINT)
   perf_process.wait()
   if on_stop_script:
-    print("*** Run on_stop_script:")
-    script_args = shlex.split(on_stop_script)
-    print("- Arguments: ", script_args)
-    env = os.environ.copy()
-    env['PERF_TARGET_PID'] = str(pid)
-    env['PERF_OUTPUT_PATH'] = perf_output
-    script_proc = subprocess.run(script_args, env=env)
-    print("- ReturnCode: ", script_proc.returncode)
+    run_on_stop_script(on_stop_script, pid, perf_output, extra_env)
+
+
+class ActionWorker:
+  # Runs --onstart/--onstop scripts and waits on perf off the loop that
+  # drains the command's stdout, so a slow script never stalls the command
+  # on a full pipe. Actions run one at a time in the order they were queued.
+  def __init__(self):
+    self.queue = queue.Queue()
+    self.thread = threading.Thread(target=self._loop)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, func, *args):
+    self.queue.put((func, args))
+
+  def join(self):
+    self.queue.put(None)
+    self.thread.join()
+
+  def _loop(self):
+    while True:
+      action = self.queue.get()
+      if action is None:
+        return
+      func, args = action
+      func(*args)
+
+
+def print_trigger_latency(windows):
+  latencies = [
+      w.trigger_latency * 1e3
+      for w in windows
+      if w.trigger_latency is not None
+  ]
+  if latencies:
+    print("*** Trigger latency (ms): n={0} min={1:.3f} median={2:.3f} "
+          "max={3:.3f}".format(
+              len(latencies), min(latencies), statistics.median(latencies),
+              max(latencies)))
+
+
+class PerfRestarter:
+  # perf record started on the first enable and stopped on disable, for perf
+  # without --control. Only a single window is captured.
+  def __init__(self, perf_argv, pid, paused, on_start_script, on_stop_script,
+               target_args=None):
+    self.perf_argv = perf_argv
+    self.pid = pid
+    self.target_args = target_args
+    self.on_start_script = on_start_script
+    self.on_stop_script = on_stop_script
+    self.output = get_perf_output(perf_argv)
+    self.windows = []
+    self.enabled = False
+    self.telemetry = None
+    self.script_env = {}
+    self.process = None
+    self.window_start = None
+    self.trigger_latency = None
+    self.worker = ActionWorker()
+    if not paused:
+      self.enable()
+
+  def enable(self, trigger_time=None, trigger_env=None):
+    if self.enabled or self.windows:
+      return
+    self.process = run_perf(self.perf_argv, self.pid, None,
+                            target_args=self.target_args)
+    self.window_start = datetime.datetime.now()
+    if trigger_time is not None:
+      self.trigger_latency = time.perf_counter() - trigger_time
+    self.enabled = True
+    if self.on_start_script:
+      self.worker.submit(run_on_start_script, self.on_start_script, self.pid,
+                         dict(self.script_env, **(trigger_env or {})))
+
+  def disable(self, trigger_env=None):
+    if not self.enabled:
+      return
+    self.enabled = False
+    self.windows.append(
+        CaptureWindow(1, self.window_start, datetime.datetime.now(),
+                      self.output, self.trigger_latency))
+    self.worker.submit(stop_perf, self.process, self.on_stop_script, self.pid,
+                       self.output,
+                       dict(self.script_env, **(trigger_env or {})))
+
+  def stop(self):
+    if self.telemetry:
+      self.telemetry.stop()
+    self.disable()
+    self.worker.join()
+    print_trigger_latency(self.windows)
+
+
+class PerfSession:
+  # perf record attached up front and toggled through its control FIFO. With
+  # split outputs, each window goes to its own file via --switch-output.
+  def __init__(self, perf_argv, pid, paused, split, on_start_script,
+               on_stop_script, target_args=None):
+    self.pid = pid
+    self.split = split
+    self.on_start_script = on_start_script
+    self.on_stop_script = on_stop_script
+    self.output = get_perf_output(perf_argv)
+    self.windows = []
+    self.enabled = not paused
+    self.window_start = None
+    self.trigger_latency = None
+    self.telemetry = None
+    self.script_env = {}
+    self.worker = ActionWorker()
+    self.fifo_dir = tempfile.mkdtemp(prefix="perf-crecord-")
+    ctl_path = os.path.join(self.fifo_dir, "ctl")
+    ack_path = os.path.join(self.fifo_dir, "ack")
+    os.mkfifo(ctl_path)
+    os.mkfifo(ack_path)
+    # O_RDWR keeps the opens from blocking until perf opens the other ends
+    self.ctl_fd = os.open(ctl_path, os.O_RDWR)
+    self.ack_fd = os.open(ack_path, os.O_RDWR)
+    args = ["perf", "record"] + (target_args or ["-p", str(pid)])
+    args += ["--control", "fifo:{0},{1}".format(ctl_path, ack_path)]
+    if paused:
+      args += ["--delay=-1"]
+    if split:
+      args += ["--switch-output=signal"]
+    args += perf_argv
+    print("*** Start perf: ")
+    print("- Arguments: ", args)
+    self.process = subprocess.Popen(args)
+    print("- PID={0}".format(self.process.pid))
+    if self.enabled:
+      self._begin_window()
+
+  def _command(self, cmd):
+    os.write(self.ctl_fd, (cmd + "\n").encode())
+    ready, _, _ = select.select([self.ack_fd], [], [], PERF_ACK_TIMEOUT)
+    if not ready:
+      print("*** No ack from perf for", cmd)
+      return False
+    os.read(self.ack_fd, 64)
+    return True
+
+  def _begin_window(self, trigger_env=None):
+    self.window_start = datetime.datetime.now()
+    if self.on_start_script:
+      self.worker.submit(run_on_start_script, self.on_start_script, self.pid,
+                         dict(self.script_env, **(trigger_env or {})))
+
+  def enable(self, trigger_time=None, trigger_env=None):
+    if self.enabled:
+      return
+    self._command("enable")
+    self.trigger_latency = None
+    if trigger_time is not None:
+      self.trigger_latency = time.perf_counter() - trigger_time
+    print("*** Enable perf: window", len(self.windows) + 1)
+    self.enabled = True
+    self._begin_window(trigger_env)
+
+  def disable(self, trigger_env=None):
+    if not self.enabled:
+      return
+    self._command("disable")
+    self.enabled = False
+    stop_time = datetime.datetime.now()
+    window = CaptureWindow(len(self.windows) + 1, self.window_start,
+                           stop_time, self.output, self.trigger_latency)
+    self.windows.append(window)
+    env = dict(self.script_env, **(trigger_env or {}))
+    env['PERF_WINDOW'] = str(window.window)
+    existing = None
+    if self.split:
+      # Signalled right away so the next window cannot land in this output
+      existing = set(glob.glob(self.output + ".[0-9]*"))
+      self.process.send_signal(signal.SIGUSR2)
+    self.worker.submit(self._finish_window, window, existing, env)
+
+  def _finish_window(self, window, existing, env):
+    if existing is not None:
+      window.output = self._wait_output(existing)
+    print("*** Disable perf: window {0} ({1:.3f} sec) -> {2}".format(
+        window.window, (window.stop - window.start).total_seconds(),
+        window.output))
+    if self.on_stop_script and self.split:
+      run_on_stop_script(self.on_stop_script, self.pid, window.output, env)
+
+  def _wait_output(self, existing):
+    # perf renames the finished output to <output>.<timestamp>
+    deadline = time.monotonic() + PERF_SWITCH_TIMEOUT
+    while time.monotonic() < deadline:
+      new = sorted(set(glob.glob(self.output + ".[0-9]*")) - existing)
+      if new:
+        return new[-1]
+      time.sleep(0.01)
+    return self.output
+
+  def stop(self):
+    if self.telemetry:
+      self.telemetry.stop()
+    self.disable()
+    self.worker.join()
+    print("*** Stop perf: ")
+    self.process.send_signal(signal.SIGINT)
+    self.process.wait()
+    os.close(self.ctl_fd)
+    os.close(self.ack_fd)
+    shutil.rmtree(self.fifo_dir, ignore_errors=True)
+    self.write_windows()
+    print_trigger_latency(self.windows)
+    if self.on_stop_script and not self.split:
+      run_on_stop_script(self.on_stop_script, self.pid, self.output,
+                         self.script_env)
+
+  def write_windows(self):
+    path = self.output + ".windows.tsv"
+    with open(path, "wt") as f:
+      f.write("window\tstart\tstop\telapsed\toutput\ttrigger_latency_ms\n")
+      for w in self.windows:
+        latency = ("" if w.trigger_latency is None else
+                   "{0:.3f}".format(w.trigger_latency * 1e3))
+        f.write("{0}\t{1}\t{2}\t{3:.6f}\t{4}\t{5}\n".format(
+            w.window, w.start.isoformat(), w.stop.isoformat(),
+            (w.stop - w.start).total_seconds(), w.output, latency))
+    print("*** Windows: {0} ({1})".format(len(self.windows), path))
 
 
 def get_perf_output(perf_argv):
@@ -70,43 +568,189 @@ def get_perf_output(perf_argv):
   return output
 
 
+def write_flamegraphs(windows, java, diff_base):
+  # Windows after the first are diffed against it unless a base is given
+  base_stacks = None
+  if diff_base:
+    base_stacks = flamegraph.load_stacks(diff_base, java)
+  palette = "java" if java else "hot"
+  for output in dict.fromkeys(w.output for w in windows):
+    prefix = output[:-len(".data")] if output.endswith(".data") else output
+    stacks = flamegraph.collapse_perf_data(output, java)
+    with open(prefix + ".collapsed", "wt") as f:
+      flamegraph.write_collapsed(stacks, f)
+    with open(prefix + "-flamegraph.svg", "wt") as f:
+      flamegraph.render_svg(stacks, f, "Flame Graph: " + output, palette)
+    print("*** Flamegraph: {0}-flamegraph.svg".format(prefix))
+    if base_stacks is None:
+      base_stacks, diff_base = stacks, output
+      continue
+    with open(prefix + "-diff.svg", "wt") as f:
+      title = "Differential Flame Graph: {0} vs {1}".format(output, diff_base)
+      flamegraph.render_svg(stacks, f, title, base_stacks=base_stacks)
+    print("*** Differential flamegraph: {0}-diff.svg".format(prefix))
+
+
+def start_telemetry(my_args, session, resolver, pid):
+  path = session.output + ".telemetry.tsv"
+  if my_args.target == "tree":
+    get_pids = lambda: get_descendants(pid)
+  else:
+    get_pids = lambda: [pid]
+  get_window = lambda: len(session.windows) + 1 if session.enabled else 0
+  session.telemetry = ProcSampler(path, my_args.telemetry_rate, get_pids,
+                                  get_window, resolver.threads)
+  session.script_env['PERF_TELEMETRY_PATH'] = path
+  session.telemetry.start()
+  print("*** Telemetry: {0} ({1} Hz)".format(path, my_args.telemetry_rate))
+
+
 def run(my_args, perf_argv, cmd_argv):
-  que = queue.Queue()
-  command_process = run_command(cmd_argv, que)
-  perf_process = None
-  if not my_args.cstart:
-    perf_process = run_perf(perf_argv, command_process.pid, my_args.onstart)
+  command_process = run_command(cmd_argv)
+  reader = OutputReader(command_process.stdout, my_args.log)
+  start_triggers = compile_triggers(my_args.cstart)
+  stop_triggers = compile_triggers(my_args.cstop)
+  paused = bool(start_triggers)
+  resolver = TargetResolver(command_process.pid, my_args.target == "tree",
+                            my_args.target_comm, my_args.target_cmdline,
+                            my_args.threads)
+  session = None
+  # A start trigger seen before the target appeared: (read_time, env)
+  pending_start = None
+  last_resolve = 0
+  # Matched threads and since when, while waiting for a pool to stop growing
+  candidate = None
+  candidate_time = 0
+  encoding = locale.getpreferredencoding(False)
   while True:
-    try:
-      line = que.get(timeout=.01)
-    except queue.Empty:
-      pass
-    else:
-      lstr = line.decode(locale.getpreferredencoding(False))
-      if not perf_process and my_args.cstart:
-        if my_args.cstart in lstr:
-          print("*** Detect Perf-Start Output:", lstr.rstrip())
-          perf_process = run_perf(perf_argv, command_process.pid,
-                                  my_args.onstart)
-      if perf_process and my_args.cstop:
-        if my_args.cstop in lstr:
-          print("*** Detect Perf-Stop Output: ", lstr.rstrip())
-          perf_output = get_perf_output(perf_argv)
-          stop_perf(perf_process, my_args.onstop, command_process.pid, perf_output)
-    if command_process.poll() is not None:
-      print("*** Command exited: {0}".format(command_process.poll()))
+    # Thread pools usually exist only once the workload starts, so a thread
+    # filter waits for the start trigger before picking threads.
+    if session is None and (pending_start or not my_args.threads or
+                            not start_triggers):
+      now = time.monotonic()
+      target = None
+      if now - last_resolve >= TARGET_POLL_INTERVAL:
+        last_resolve = now
+        target = resolver.resolve()
+      # perf -t cannot follow threads started later, so with no trigger to
+      # wait for, threads are picked once the matched set has settled
+      if target and my_args.threads and not pending_start:
+        if target != candidate:
+          candidate, candidate_time = target, now
+          target = None
+        elif now - candidate_time < TARGET_STABLE_TIME:
+          target = None
+      if target:
+        pid, target_args = target
+        print("*** Target: PID={0} {1}".format(pid, " ".join(target_args)))
+        if my_args.no_control:
+          session = PerfRestarter(perf_argv, pid, paused, my_args.onstart,
+                                  my_args.onstop, target_args)
+        else:
+          session = PerfSession(perf_argv, pid, paused, not my_args.no_split,
+                                my_args.onstart, my_args.onstop, target_args)
+        if my_args.telemetry:
+          start_telemetry(my_args, session, resolver, pid)
+        if pending_start:
+          session.enable(*pending_start)
+    lines, read_time = reader.read(READ_TIMEOUT)
+    if lines is None:
+      if command_process.poll() is not None:
+        break
+      continue
+    # Only lines with a trigger match get decoded
+    pos = 0
+    while True:
+      enabled = session.enabled if session else pending_start is not None
+      triggers = stop_triggers if enabled else start_triggers
+      m = find_trigger(triggers, lines, pos)
+      if m is None:
+        break
+      begin = lines.rfind(b"\n", 0, m.start()) + 1
+      pos = lines.find(b"\n", m.end())
+      pos = len(lines) if pos < 0 else pos + 1
+      line = lines[begin:pos].decode(encoding, errors="replace").rstrip()
+      trigger_env = get_trigger_env(line, m)
+      if enabled:
+        print("*** Detect Perf-Stop Output: ", line)
+        if session:
+          session.disable(trigger_env)
+        pending_start = None
+      else:
+        print("*** Detect Perf-Start Output:", line)
+        if session:
+          session.enable(read_time, trigger_env)
+        else:
+          pending_start = (read_time, trigger_env)
+    if not lines:
       break
-  if perf_process is None:
+  command_process.wait()
+  reader.close()
+  print("*** Command exited: {0}".format(command_process.returncode))
+  if session:
+    session.stop()
+  if not session or not session.windows:
       print("*** Did not start perf")
       sys.exit(1)
+  if my_args.flamegraph:
+    write_flamegraphs(session.windows, my_args.java, my_args.diff_base)
 
 
 def parse_argument():
   parser = argparse.ArgumentParser(description='perf-crecord command')
-  parser.add_argument('--cstart', help="Output pattern to start perf")
-  parser.add_argument('--cstop', help="Output pattern to stop perf")
+  parser.add_argument(
+      '--cstart',
+      action="append",
+      help="Output regex to start perf (repeatable)")
+  parser.add_argument(
+      '--cstop', action="append", help="Output regex to stop perf (repeatable)")
   parser.add_argument('--onstart', help="Command to run on perf-start")
   parser.add_argument('--onstop', help="Command to run on perf-stop")
+  parser.add_argument(
+      '--no_control',
+      action="store_true",
+      help="Start and stop perf on each trigger (for perf without --control)")
+  parser.add_argument(
+      '--no_split',
+      action="store_true",
+      help="Keep all capture windows in a single perf output")
+  parser.add_argument(
+      '--log', help="Write the command's output to this file, not the console")
+  parser.add_argument(
+      '--target',
+      choices=["child", "tree"],
+      default="child",
+      help="Attach to the command only or to its whole process tree")
+  parser.add_argument(
+      '--target_comm',
+      help="Attach to the first descendant whose name matches this regex")
+  parser.add_argument(
+      '--target_cmdline',
+      help="Attach to the first descendant whose command line matches")
+  parser.add_argument(
+      '--threads',
+      help="Only capture threads whose names match this regex, as of the "
+      "start trigger or once no more of them appear")
+  parser.add_argument(
+      '--telemetry',
+      action="store_true",
+      help="Sample the target's /proc stats next to the perf output")
+  parser.add_argument(
+      '--telemetry_rate',
+      type=float,
+      default=10,
+      help="Telemetry samples per second")
+  parser.add_argument(
+      '--flamegraph',
+      action="store_true",
+      help="Write collapsed stacks and a flamegraph for each perf output")
+  parser.add_argument(
+      '--java',
+      action="store_true",
+      help="Clean up perf-map-agent frames in flamegraphs")
+  parser.add_argument(
+      '--diff_base',
+      help="perf.data or collapsed stacks to diff each flamegraph against")
 
   remains = sys.argv[1:]
   if "--" not in remains:
@@ -1,41 +1,146 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import concurrent.futures
 import datetime
+import functools
+import glob
+import heapq
+import http.server
+import importlib
+import itertools
 import json
+import math
+import multiprocessing
 import os
+import queue
+import random
 import re
+import resource
+import selectors
+import shlex
+import shutil
+import signal
+import socket
+import sqlite3
+import string
 import subprocess
 import sys
-import tempfile
+import threading
 import time
 from dataclasses import dataclass
 
-PERCENTILES = [0.01, 0.25, 0.50, 0.75, 0.99]
+try:
+  import yaml
+except ImportError:
+  yaml = None
+
+PERCENTILES = [1, 25, 50, 75, 99]
+PERF_CSV_SEP = ";"
+SKETCH_MIN_VALUE = 1e-9
+CI_Z = 1.96
+# Fewer runs than this never count as converged
+CI_MIN_RUNS = 10
+MB = 1 << 20
+LIVE_METRICS_PERCENTILES = [50, 90, 99]
+TRACE_PID = 1
+CALLABLE_BATCH_SIZE = 1000
+COMPARE_STATS = ["p50", "p99", "runs/sec"]
+# Batches are also sent this often so live metrics keep up with slow calls
+CALLABLE_BATCH_INTERVAL = 0.1
+CALIBRATION_FILE = "runs-calibration.json"
+# The first one is used to estimate the overhead of runs
+CALIBRATION_COMMANDS = [
+    ("true", ["true"]),
+    ("sleep0", ["sleep", "0"]),
+    ("busyloop",
+     ["sh", "-c", "i=0; while [ $i -lt 1000 ]; do i=$((i+1)); done"]),
+]
+# (name, runs.py arguments, command or None for the in-process no-op)
+HARNESS_BENCH_SCENARIOS = [
+    ("closed-t1", ["-t", "1"], ["true"]),
+    ("closed-t64", ["-t", "64"], ["true"]),
+    ("open-rate", ["--rate", "500", "--max_inflight", "64"], ["true"]),
+    ("capture", ["-t", "8", "--metric", "v=value (\\d+)"],
+     ["echo", "value 1"]),
+    ("sampler", ["-t", "8", "--sample_rate", "100"], ["true"]),
+    ("callable", ["-t", "4"], None),
+]
+# Gives perf stat time to attach to the workers before they start
+CALLABLE_PERF_ATTACH_DELAY = 0.5
+RESULT_DB_COMMIT_INTERVAL = 1.0
+SWEEP_MAX_FORMAT_DEPTH = 4
+# Serializes report writes of sweep cells running in parallel
+REPORT_LOCK = threading.Lock()
 
 
 @dataclass
-class PerfStat:
-  task_clock: float = 0
-  context_switches: int = 0
-  cpu_migrations: int = 0
-  page_faults: int = 0
-  cycles: int = 0
-  instructions: int = 0
-  branches: int = 0
-  branch_misses: int = 0
-  wall_time: float = 0
-  user_time: float = 0
-  sys_time: float = 0
-
-
-PERF_STAT_FIELDS = [
-    'task_clock', 'context_switches', 'cpu_migrations', 'page_faults', 'cycles',
-    'instructions', 'branches', 'branch_misses', 'wall_time', 'user_time',
-    'sys_time'
+class RunResult:
+  id: int
+  code: int
+  # When the run was supposed to start. This is later than start_time only
+  # for open-loop runs that were delayed by the harness.
+  intended_time: datetime.datetime
+  start_time: datetime.datetime
+  end_time: datetime.datetime
+  perf_stat: dict
+  slot: int = 0
+  cpus: list = None
+  rusage: dict = None
+  metrics: dict = None
+
+
+# Resource usage of a run from wait4, which covers the child (perf stat when
+# wrapped) and all of its descendants that were waited for. On Linux the
+# ru_maxrss of a child starts from the RSS of the process it was forked from,
+# so max_rss is only reported when it exceeds the harness's own peak RSS;
+# below that it would be the harness's size, not the run's. When wrapped by
+# perf stat, perf's own RSS is a floor of it as well.
+RUSAGE_FIELDS = [
+    'max_rss', 'minor_faults', 'major_faults', 'voluntary_switches',
+    'involuntary_switches', 'block_in', 'block_out', 'user_time', 'sys_time'
 ]
 
 
+def get_rusage_stat(rusage):
+  stat = {
+      'max_rss': rusage.ru_maxrss,
+      'minor_faults': rusage.ru_minflt,
+      'major_faults': rusage.ru_majflt,
+      'voluntary_switches': rusage.ru_nvcsw,
+      'involuntary_switches': rusage.ru_nivcsw,
+      'block_in': rusage.ru_inblock,
+      'block_out': rusage.ru_oublock,
+      'user_time': rusage.ru_utime,
+      'sys_time': rusage.ru_stime,
+  }
+  if rusage.ru_maxrss <= resource.getrusage(resource.RUSAGE_SELF).ru_maxrss:
+    del stat['max_rss']
+  return stat
+
+
+def check_perf(args):
+  # Falls back to no perf when perf is missing or cannot open counters,
+  # e.g. when perf_event_paranoid forbids it, rather than failing every run.
+  if args.no_perf:
+    return
+  if shutil.which("perf") is None:
+    print("perf is not found, running without perf stat")
+    args.no_perf = True
+    return
+  perf_events_argv = ["-e", args.perf_events] if args.perf_events else []
+  p = subprocess.run(
+      ["perf", "stat", "-x", PERF_CSV_SEP] + perf_events_argv + ["--", "true"],
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.PIPE)
+  if p.returncode != 0:
+    error = p.stderr.decode("utf-8", "replace").strip().splitlines()
+    print("perf stat cannot run ({0}), running without perf stat".format(
+        error[0] if error else "exit code {0}".format(p.returncode)))
+    args.no_perf = True
+
+
 @dataclass
 class CpuStat:
   time: datetime.datetime
@@ -74,246 +179,1962 @@ class NetStat:
 NET_STAT_FIELDS = ['in_bandwith', 'out_bandwith']
 
 
-def init_cpu_stat_proc():
-  try:
-    return subprocess.Popen(["iostat", "-c", "-o", "JSON", "1", "2"],
-                            stdout=subprocess.PIPE)
-  except OSError as e:
-    print(e)
-    return None
+class SysSampler:
+  def __init__(self, rate, callback=None):
+    self.interval = 1.0 / rate
+    # Samples are handed to the callback if given, kept otherwise
+    self.callback = callback
+    self.samples = []
+    self._stop_event = threading.Event()
+    self._thread = threading.Thread(target=self._loop, daemon=True)
+    self._fds = {}
+    self._last_cpu = None
+    self._last_net = None
 
+  def start(self):
+    try:
+      for name in ["stat", "meminfo", "net/dev"]:
+        self._fds[name] = os.open("/proc/" + name, os.O_RDONLY)
+    except OSError as e:
+      print(e)
+      self._close()
+      return False
+    self._last_cpu = self._read_cpu()
+    self._last_net = (time.monotonic(), self._read_net())
+    self._thread.start()
+    return True
 
-def get_cpu_stat(p):
-  if p is None:
-    return None
-  j = json.loads(p.communicate()[0])
-  cpu_stat = j["sysstat"]["hosts"][0]["statistics"][-1]["avg-cpu"]
-  return CpuStat(datetime.datetime.now(), cpu_stat['user'], cpu_stat['nice'],
-                 cpu_stat['system'], cpu_stat['iowait'], cpu_stat['steal'],
-                 cpu_stat['idle'])
+  def stop(self):
+    if self._thread.is_alive():
+      self._stop_event.set()
+      self._thread.join()
+    self._close()
 
+  def _close(self):
+    for fd in self._fds.values():
+      os.close(fd)
+    self._fds = {}
 
-def get_mem_stat():
-  try:
-    o = subprocess.check_output(["free"])
-    for l in o.decode('utf-8').split("\n"):
-      if l.startswith("Mem:"):
-        values = [int(w) for w in l[5:].split()]
-        if len(values) == 6:
-          return MemStat(datetime.datetime.now(), values[0], values[1],
-                         values[2], values[3], values[4], values[5])
-    return None
-  except OSError as e:
-    print(e)
-    return None
+  def _read(self, name):
+    return os.pread(self._fds[name], 1 << 16, 0).decode('ascii')
 
+  def _read_cpu(self):
+    # cpu user nice system idle iowait irq softirq steal guest guest_nice
+    l = self._read("stat").split("\n", 1)[0]
+    return [int(w) for w in l.split()[1:]]
 
-def init_net_stat_proc():
-  try:
-    return subprocess.Popen(["ifstat", "-Tq", "1", "1"], stdout=subprocess.PIPE)
-  except OSError as e:
-    print(e)
-    return None
+  def _read_net(self):
+    rx, tx = 0, 0
+    for l in self._read("net/dev").split("\n")[2:]:
+      if ":" not in l:
+        continue
+      iface, data = l.split(":", 1)
+      if iface.strip() == "lo":
+        continue
+      values = data.split()
+      rx += int(values[0])
+      tx += int(values[8])
+    return rx, tx
 
+  def _get_cpu_stat(self, now):
+    cur = self._read_cpu()
+    d = [c - l for c, l in zip(cur, self._last_cpu)]
+    self._last_cpu = cur
+    d += [0] * (10 - len(d))
+    total = sum(d[:8])
+    if total <= 0:
+      return None
+    pct = lambda v: 100.0 * v / total
+    return CpuStat(now, pct(d[0] - d[8]), pct(d[1] - d[9]),
+                   pct(d[2] + d[5] + d[6]), pct(d[4]), pct(d[7]), pct(d[3]))
 
-def get_net_stat(p):
-  if p is None:
-    return None
-  o = p.communicate()[0]
-  l = [l for l in o.decode('utf-8').split("\n") if l.strip()][-1]
-  values = [int(float(w) * 1024) for w in l.split()]
-  if len(values) >= 2:
-    return NetStat(datetime.datetime.now(), values[-2], values[-1])
-  return None
-
-
-def parse_float(s):
-  return float(s.replace(",", ""))
-
-
-def parse_int(s):
-  return int(s.replace(",", ""))
-
-
-def parse_perf_stat_output(output):
-  stat = PerfStat()
-  mo = re.search(r"([0-9.,]+)\s+msec\s+task-clock", output)
-  if mo:
-    stat.task_clock = parse_float(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+context-switches", output)
-  if mo:
-    stat.context_switches = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+cpu-migrations", output)
-  if mo:
-    stat.cpu_migrations = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+page-faults", output)
-  if mo:
-    stat.page_faults = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+cycles", output)
-  if mo:
-    stat.cycles = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+instructions", output)
-  if mo:
-    stat.instructions = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+branches", output)
-  if mo:
-    stat.branches = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+branch-misses", output)
-  if mo:
-    stat.branch_misses = parse_int(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+seconds time elapsed", output)
-  if mo:
-    stat.wall_time = parse_float(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+seconds user", output)
-  if mo:
-    stat.user_time = parse_float(mo.group(1))
-  mo = re.search(r"([0-9.,]+)\s+seconds sys", output)
-  if mo:
-    stat.sys_time = parse_float(mo.group(1))
+  def _get_mem_stat(self, now):
+    info = {}
+    for l in self._read("meminfo").split("\n"):
+      w = l.split()
+      if len(w) >= 2:
+        info[w[0].rstrip(":")] = int(w[1])
+    total = info.get("MemTotal", 0)
+    available = info.get("MemAvailable", info.get("MemFree", 0))
+    cache = (info.get("Buffers", 0) + info.get("Cached", 0) +
+             info.get("SReclaimable", 0))
+    return MemStat(now, total, total - available, info.get("MemFree", 0),
+                   info.get("Shmem", 0), cache, available)
+
+  def _get_net_stat(self, now):
+    t = time.monotonic()
+    cur = self._read_net()
+    last_t, last = self._last_net
+    self._last_net = (t, cur)
+    if t <= last_t:
+      return None
+    return NetStat(now, int((cur[0] - last[0]) / (t - last_t)),
+                   int((cur[1] - last[1]) / (t - last_t)))
+
+  def _loop(self):
+    while not self._stop_event.wait(self.interval):
+      now = datetime.datetime.now()
+      try:
+        cpu_stat = self._get_cpu_stat(now)
+        mem_stat = self._get_mem_stat(now)
+        net_stat = self._get_net_stat(now)
+      except (OSError, ValueError, IndexError) as e:
+        print(e)
+        continue
+      if cpu_stat and mem_stat and net_stat:
+        if self.callback:
+          self.callback((cpu_stat, mem_stat, net_stat))
+        else:
+          self.samples.append((cpu_stat, mem_stat, net_stat))
+
+
+def parse_perf_stat_csv(output):
+  # perf stat -x, prints "value,unit,event,run-time,pct,metric,metric-unit"
+  stat = {}
+  for l in output.split("\n"):
+    if not l or l.startswith("#"):
+      continue
+    values = l.split(PERF_CSV_SEP)
+    if len(values) < 3 or not values[2]:
+      continue
+    try:
+      v = float(values[0])
+    except ValueError:
+      # <not counted> or <not supported>
+      continue
+    stat[values[2].replace("-", "_")] = v
   return stat
 
 
-def get_mid(vals):
-  if vals:
-    return sorted(vals)[len(vals) // 2]
-  return None
+class QuantileSketch:
+  # Log-bucketed histogram (DDSketch) whose quantiles are within the relative
+  # accuracy of the exact ones. Memory depends on the value range, not count.
+  def __init__(self, relative_accuracy=0.01):
+    self.relative_accuracy = relative_accuracy
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.positives = {}
+    self.negatives = {}
+    self.zeros = 0
+    self.count = 0
+    self.sum = 0
+    self.min = None
+    self.max = None
 
+  def add(self, value):
+    if value > SKETCH_MIN_VALUE:
+      i = math.ceil(math.log(value) / self.log_gamma)
+      self.positives[i] = self.positives.get(i, 0) + 1
+    elif value < -SKETCH_MIN_VALUE:
+      i = math.ceil(math.log(-value) / self.log_gamma)
+      self.negatives[i] = self.negatives.get(i, 0) + 1
+    else:
+      self.zeros += 1
+    self.count += 1
+    self.sum += value
+    if self.min is None or value < self.min:
+      self.min = value
+    if self.max is None or value > self.max:
+      self.max = value
 
-def print_stats(start_time, end_time, results, sys_stats):
-  elapsed_time = datetime.datetime.now() - start_time
-  error_runs = sum(1 if r[0] != 0 else 0 for r in results)
-  print("Elapsed time: {0} sec".format(elapsed_time.total_seconds()))
-  print("Total runs: {0} errors: {1}".format(len(results), error_runs))
-  times = sorted(r[2] - r[1] for r in results)
-  print("Run:")
-  for p in PERCENTILES:
-    p_value = times[int(len(times) * p)].total_seconds()
-    print("  p{0:.2f}: {1:.2f} sec".format(p, p_value))
-  perf_stats = list(sorted((r[3] for r in results), key=lambda x: x.task_clock))
-  perf_stat_mid = perf_stats[len(perf_stats) // 2]
-  print("Perf (p50):")
-  for f in PERF_STAT_FIELDS:
-    print("  {0}: {1}".format(f, getattr(perf_stat_mid, f)))
-  if sys_stats:
-    print("CPU:")
+  def merge(self, other):
+    for i, n in other.positives.items():
+      self.positives[i] = self.positives.get(i, 0) + n
+    for i, n in other.negatives.items():
+      self.negatives[i] = self.negatives.get(i, 0) + n
+    self.zeros += other.zeros
+    self.count += other.count
+    self.sum += other.sum
+    for v in (other.min, other.max):
+      if v is not None:
+        self.min = v if self.min is None else min(self.min, v)
+        self.max = v if self.max is None else max(self.max, v)
+
+  def _value(self, i, sign=1):
+    v = sign * 2 * self.gamma**i / (self.gamma + 1)
+    return min(max(v, self.min), self.max)
+
+  def quantile(self, q):
+    if self.count == 0:
+      return None
+    rank = q * (self.count - 1)
+    n = 0
+    for i in sorted(self.negatives, reverse=True):
+      n += self.negatives[i]
+      if n > rank:
+        return self._value(i, -1)
+    n += self.zeros
+    if n > rank:
+      return 0
+    for i in sorted(self.positives):
+      n += self.positives[i]
+      if n > rank:
+        return self._value(i)
+    return self.max
+
+
+class RunStats:
+  def __init__(self, overhead=0):
+    self.runs = 0
+    self.errors = 0
+    self.groups = {}
+    # The calibrated harness overhead. Samples are kept as measured and only
+    # adjusted_quantile() takes it off.
+    self.overhead = overhead
+    # Runs done when --target_ci was reached, before in-flight ones finished
+    self.converged_runs = None
+
+  def add(self, group, field, value):
+    sketches = self.groups.setdefault(group, {})
+    sketch = sketches.get(field)
+    if sketch is None:
+      sketch = sketches[field] = QuantileSketch()
+    sketch.add(value)
+
+  def add_result(self, result):
+    self.runs += 1
+    if result.code != 0:
+      self.errors += 1
+    self.add("Run", "time",
+             (result.end_time - result.start_time).total_seconds())
+    self.add("Run", "response_time",
+             (result.end_time - result.intended_time).total_seconds())
+    for f, v in result.perf_stat.items():
+      self.add("Perf", f, v)
+    for f, v in (result.rusage or {}).items():
+      self.add("Rusage", f, v)
+    for f, v in (result.metrics or {}).items():
+      self.add("Metric", f, v)
+
+  def add_sys_stat(self, sys_stat):
+    cpu_stat, mem_stat, net_stat = sys_stat
     for f in CPU_STAT_FIELDS:
-      values = [getattr(sys_stat[0], f) for sys_stat in sys_stats]
-      print("  {0}: {1:.2f}".format(f, get_mid(values)))
-    print("MEM:")
+      self.add("CPU", f, getattr(cpu_stat, f))
     for f in MEM_STAT_FIELDS:
-      values = [getattr(sys_stat[1], f) for sys_stat in sys_stats]
-      print("  {0}: {1:.2f}".format(f, get_mid(values)))
-    print("NET:")
+      self.add("MEM", f, getattr(mem_stat, f))
     for f in NET_STAT_FIELDS:
-      values = [getattr(sys_stat[2], f) for sys_stat in sys_stats]
-      print("  {0}: {1:.2f}".format(f, get_mid(values)))
-
-
-
-def write_report(start_time, end_time, results, sys_stats, args):
-  elapsed_time = datetime.datetime.now() - start_time
-  error_runs = sum(1 if r[0] != 0 else 0 for r in results)
-  times = sorted(r[2] - r[1] for r in results)
-  is_new_file = not os.path.exists(args.report_file)
-  with open(args.report_file, "at") as f:
-    if is_new_file:
-      all_columns = ([
-          "Time", "Tag", "Elapsed", "Threads", "Runs", "Errors", "Run-P01-T",
-          "Run-P25-T", "Run-P50-T", "Run-P75-T", "Run-P99-T"
-      ] + ["PERF-" + f for f in PERF_STAT_FIELDS] +
-                     ["CPU-" + f for f in CPU_STAT_FIELDS] +
-                     ["MEM-" + f for f in MEM_STAT_FIELDS] +
-                     ["NET-" + f for f in NET_STAT_FIELDS])
-      f.write("\t".join(all_columns) + "\n")
-    f.write("{0}\t{1}\t{2:.2f}\t{3}\t{4}\t{5}".format(
-        start_time, args.report_tag, elapsed_time.total_seconds(), args.threads,
-        args.runs, error_runs))
-    for p in PERCENTILES:
-      p_value = times[int(len(times) * p)].total_seconds()
-      f.write("\t{0:.2f}".format(p_value))
-    perf_stats = list(
-        sorted((r[3] for r in results), key=lambda x: x.task_clock))
-    perf_stat_mid = perf_stats[len(perf_stats) // 2]
-    for field in PERF_STAT_FIELDS:
-      v = getattr(perf_stat_mid, field)
-      f.write("\t{0:.2f}".format(v))
-    for field in CPU_STAT_FIELDS:
-      if sys_stats:
-        values = [getattr(sys_stat[0], field) for sys_stat in sys_stats]
-        v = get_mid(values)
-      else:
-        v = 0
-      f.write("\t{0:.2f}".format(v))
-    for field in MEM_STAT_FIELDS:
-      if sys_stats:
-        values = [getattr(sys_stat[1], field) for sys_stat in sys_stats]
-        v = get_mid(values)
+      self.add("NET", f, getattr(net_stat, f))
+
+  def merge(self, other):
+    self.runs += other.runs
+    self.errors += other.errors
+    for group, sketches in other.groups.items():
+      for field, sketch in sketches.items():
+        mine = self.groups.setdefault(group, {}).get(field)
+        if mine is None:
+          mine = self.groups[group][field] = QuantileSketch()
+        mine.merge(sketch)
+
+  def fields(self, group):
+    return list(self.groups.get(group, {}))
+
+  def adjusted_quantile(self, field, p):
+    # A run time percentile less the overhead, which shifts every run alike
+    return max(self.quantile("Run", field, p) - self.overhead, 0)
+
+  def quantile_ci(self, group, field, p, z=CI_Z):
+    # Distribution-free confidence interval of a quantile from the ranks
+    # n*q +/- z*sqrt(n*q*(1-q)) of the order statistics. None until both
+    # ranks fall inside the sample, since clamping them would just give the
+    # range. The bounds are widened by the sketch accuracy so two ranks in
+    # one bucket do not look like a zero-width interval.
+    sketch = self.groups.get(group, {}).get(field)
+    if sketch is None or sketch.count < CI_MIN_RUNS:
+      return None
+    n = sketch.count
+    q = p / 100.0
+    d = z * math.sqrt(n * q * (1 - q))
+    if n * q - d < 0 or n * q + d > n - 1:
+      return None
+    lo = sketch.quantile(math.floor(n * q - d) / (n - 1))
+    hi = sketch.quantile(math.ceil(n * q + d) / (n - 1))
+    a = sketch.relative_accuracy
+    return (max(lo - a * abs(lo), sketch.min), min(hi + a * abs(hi),
+                                                   sketch.max))
+
+  def is_converged(self, group, field, p, target_ci):
+    ci = self.quantile_ci(group, field, p)
+    v = self.quantile(group, field, p)
+    if ci is None or not v:
+      return False
+    return (ci[1] - ci[0]) / v * 100 <= target_ci
+
+  def quantile(self, group, field, p):
+    sketch = self.groups.get(group, {}).get(field)
+    if sketch is None:
+      return None
+    return sketch.quantile(p / 100.0)
+
+
+def format_seconds(v):
+  if v >= 1 or v == 0:
+    return "{0:.2f} sec".format(v)
+  if v >= 1e-3:
+    return "{0:.2f} ms".format(v * 1e3)
+  return "{0:.2f} us".format(v * 1e6)
+
+
+def format_percentile(p):
+  return "{0:02g}".format(p)
+
+
+def get_aggregate_throughput(elapsed_time, stats, args):
+  # MB/s of all successful runs across concurrent workers
+  seconds = elapsed_time.total_seconds()
+  if not seconds:
+    return 0
+  return (stats.runs - stats.errors) * args.bytes_per_run / MB / seconds
+
+
+def print_run_percentiles(stats, field, args):
+  for p in args.percentiles:
+    line = "  p{0}: {1}".format(format_percentile(p),
+                                format_seconds(stats.quantile("Run", field, p)))
+    if args.subtract_calibration:
+      line += " (adjusted: {0})".format(
+          format_seconds(stats.adjusted_quantile(field, p)))
+    print(line)
+
+
+def print_stats(start_time, end_time, stats, args):
+  elapsed_time = end_time - start_time
+  print("Elapsed time: {0} sec".format(elapsed_time.total_seconds()))
+  print("Total runs: {0} errors: {1}".format(stats.runs, stats.errors))
+  if args.bytes_per_run:
+    print("Throughput: {0:.2f} MB/s".format(
+        get_aggregate_throughput(elapsed_time, stats, args)))
+  if args.calibration:
+    print("Harness overhead (calibrated): {0}{1}".format(
+        format_seconds(get_calibrated_overhead(args)),
+        " (subtracted from adjusted times)"
+        if args.subtract_calibration else ""))
+  if args.rate:
+    print("Offered rate: {0:.2f}/sec Achieved rate: {1:.2f}/sec".format(
+        args.rate, stats.runs / elapsed_time.total_seconds()))
+  if stats.runs:
+    print("Run:" if not args.rate else "Run (service time):")
+    print_run_percentiles(stats, "time", args)
+  if stats.runs and args.target_ci:
+    ci = stats.quantile_ci("Run", "time", args.ci_percentile) or (0, 0)
+    if stats.converged_runs is not None:
+      status = "Converged after {0} runs ({1} in total)".format(
+          stats.converged_runs, stats.runs)
+    else:
+      status = "Not converged after {0} runs".format(stats.runs)
+    print("{0}: p{1} {2:.0f}% CI [{3:.3f}, {4:.3f}] sec".format(
+        status, format_percentile(args.ci_percentile), 95, ci[0], ci[1]))
+  if stats.runs and args.rate:
+    print("Run (response time):")
+    print_run_percentiles(stats, "response_time", args)
+  header = "/".join("p" + format_percentile(p) for p in args.percentiles)
+  for group in ["Metric", "Perf", "Rusage", "CPU", "MEM", "NET"]:
+    fields = stats.fields(group)
+    if not fields:
+      continue
+    print("{0} ({1}):".format(group, header))
+    for f in fields:
+      values = [stats.quantile(group, f, p) for p in args.percentiles]
+      print("  {0}: {1}".format(f, " / ".join("{0:.2f}".format(v)
+                                              for v in values)))
+
+
+def write_report(start_time, end_time, stats, args):
+  with REPORT_LOCK:
+    write_report_locked(start_time, end_time, stats, args)
+
+
+def get_report_columns(start_time, end_time, stats, args):
+  # (column, value) pairs; the leading columns keep the order of the original
+  # fixed layout so old report files stay appendable.
+  elapsed_time = end_time - start_time
+  metric_fields = [name for name, _ in args.metric or []]
+  if args.bytes_per_run:
+    metric_fields.append("MBps")
+  columns = [("Time", start_time), ("Tag", args.report_tag),
+             ("Elapsed", "{0:.2f}".format(elapsed_time.total_seconds())),
+             ("Threads", args.threads), ("Runs", stats.runs),
+             ("Errors", stats.errors)]
+  fields = ["time", "response_time"] if args.rate else ["time"]
+  for field in fields:
+    for p in args.percentiles:
+      columns.append(("Run-P{0}-{1}".format(format_percentile(p),
+                                            field[0].upper()),
+                      stats.quantile("Run", field, p)))
+  if args.subtract_calibration:
+    for field in fields:
+      for p in args.percentiles:
+        columns.append(("Run-P{0}-{1}-Adjusted".format(
+            format_percentile(p), field[0].upper()),
+                        stats.adjusted_quantile(field, p)))
+  columns += [("PERF-" + f, stats.quantile("Perf", f, 50))
+              for f in stats.fields("Perf")]
+  # perf stat used to report these; they now come from the run and rusage
+  columns += [("PERF-wall_time", stats.quantile("Run", "time", 50)),
+              ("PERF-user_time", stats.quantile("Rusage", "user_time", 50)),
+              ("PERF-sys_time", stats.quantile("Rusage", "sys_time", 50))]
+  groups = [("CPU-", "CPU", CPU_STAT_FIELDS), ("MEM-", "MEM", MEM_STAT_FIELDS),
+            ("NET-", "NET", NET_STAT_FIELDS),
+            ("RUSAGE-", "Rusage", RUSAGE_FIELDS),
+            ("METRIC-", "Metric", metric_fields)]
+  for prefix, group, fields in groups:
+    columns += [(prefix + f, stats.quantile(group, f, 50)) for f in fields]
+  if args.bytes_per_run:
+    columns.append(("Throughput-MBps",
+                    get_aggregate_throughput(elapsed_time, stats, args)))
+  return [(name, str(v) if i < 6 else "{0:.2f}".format(v or 0))
+          for i, (name, v) in enumerate(columns)]
+
+
+def read_report_header(path):
+  with open(path, "rt") as f:
+    return f.readline().rstrip("\n").split("\t")
+
+
+def add_report_columns(path, names):
+  # Appends empty columns to every row, as the earlier runs did not have them
+  with open(path, "rt") as f:
+    lines = f.read().splitlines()
+  tmp_path = path + ".tmp"
+  with open(tmp_path, "wt") as f:
+    f.write("\t".join([lines[0]] + names) + "\n")
+    for line in lines[1:]:
+      f.write(line + "\t" * len(names) + "\n")
+  os.replace(tmp_path, path)
+
+
+def write_report_locked(start_time, end_time, stats, args):
+  columns = get_report_columns(start_time, end_time, stats, args)
+  names = [name for name, _ in columns]
+  path = args.report_file
+  header = None
+  if os.path.exists(path) and os.path.getsize(path) > 0:
+    header = read_report_header(path)
+  if header and header != names:
+    if header[:6] == names[:6]:
+      # Writes in the file's own column order so rows never misalign, after
+      # adding the columns the file does not have yet
+      added = [n for n in names if n not in header]
+      if added:
+        add_report_columns(path, added)
+        header += added
+        print("{0}: added columns {1}".format(path, " ".join(added)))
+      values = dict(columns)
+      columns = [(n, values.get(n, "")) for n in header]
+    else:
+      root, ext = os.path.splitext(path)
+      path = "{0}-{1:%Y%m%d-%H%M%S}{2}".format(root, start_time, ext)
+      print("{0} is not a runs.py report, writing {1}".format(
+          args.report_file, path))
+      header = None
+  with open(path, "at") as f:
+    if not header:
+      f.write("\t".join(name for name, _ in columns) + "\n")
+    f.write("\t".join(v for _, v in columns) + "\n")
+
+
+RESULT_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invocations (
+  id INTEGER PRIMARY KEY,
+  start_time REAL,
+  end_time REAL,
+  host TEXT,
+  tag TEXT,
+  threads INTEGER,
+  runs INTEGER,
+  errors INTEGER,
+  command TEXT,
+  args TEXT
+);
+CREATE TABLE IF NOT EXISTS runs (
+  id INTEGER PRIMARY KEY,
+  invocation_id INTEGER,
+  run_id INTEGER,
+  code INTEGER,
+  intended_time REAL,
+  start_time REAL,
+  end_time REAL,
+  time REAL,
+  response_time REAL,
+  slot INTEGER,
+  cpus TEXT
+);
+CREATE TABLE IF NOT EXISTS run_metrics (
+  run INTEGER,
+  name TEXT,
+  value REAL
+);
+CREATE TABLE IF NOT EXISTS samples (
+  invocation_id INTEGER,
+  time REAL,
+  name TEXT,
+  value REAL
+);
+CREATE INDEX IF NOT EXISTS invocations_tag ON invocations (tag, threads);
+CREATE INDEX IF NOT EXISTS invocations_start ON invocations (start_time);
+CREATE INDEX IF NOT EXISTS runs_invocation ON runs (invocation_id);
+CREATE INDEX IF NOT EXISTS runs_start ON runs (start_time);
+CREATE INDEX IF NOT EXISTS run_metrics_run ON run_metrics (run, name);
+CREATE INDEX IF NOT EXISTS samples_invocation ON samples (invocation_id, name);
+"""
+
+# Run columns that can be queried directly, others come from run_metrics
+RESULT_DB_RUN_METRICS = ["time", "response_time"]
+
+
+class ResultStore:
+  def __init__(self, path):
+    # The sampler thread adds samples while the dispatcher adds runs
+    self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+    self.conn.execute("PRAGMA journal_mode=WAL")
+    self.conn.executescript(RESULT_DB_SCHEMA)
+    self._add_missing_columns("runs", {"slot": "INTEGER", "cpus": "TEXT"})
+    self.lock = threading.Lock()
+    self.invocation_id = None
+    self.last_commit = time.monotonic()
+
+  def _add_missing_columns(self, table, columns):
+    # Upgrades dbs created by older versions of runs.py
+    existing = set(
+        r[1] for r in self.conn.execute("PRAGMA table_info({0})".format(table)))
+    for name, column_type in columns.items():
+      if name not in existing:
+        self.conn.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(
+            table, name, column_type))
+
+  def begin(self, start_time, args, cmds):
+    with self.lock:
+      cur = self.conn.execute(
+          "INSERT INTO invocations (start_time, host, tag, threads, command, "
+          "args) VALUES (?, ?, ?, ?, ?, ?)",
+          (start_time.timestamp(), socket.gethostname(), args.report_tag,
+           args.threads, shlex.join(cmds), json.dumps(vars(args), default=str)))
+      self.invocation_id = cur.lastrowid
+      self.conn.commit()
+
+  def _maybe_commit(self):
+    now = time.monotonic()
+    if now - self.last_commit >= RESULT_DB_COMMIT_INTERVAL:
+      self.conn.commit()
+      self.last_commit = now
+
+  def add_result(self, result):
+    with self.lock:
+      cur = self.conn.execute(
+          "INSERT INTO runs (invocation_id, run_id, code, intended_time, "
+          "start_time, end_time, time, response_time, slot, cpus) "
+          "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+          (self.invocation_id, result.id, result.code,
+           result.intended_time.timestamp(), result.start_time.timestamp(),
+           result.end_time.timestamp(),
+           (result.end_time - result.start_time).total_seconds(),
+           (result.end_time - result.intended_time).total_seconds(),
+           result.slot, ",".join(str(c) for c in result.cpus or []) or None))
+      self.conn.executemany(
+          "INSERT INTO run_metrics (run, name, value) VALUES (?, ?, ?)",
+          [(cur.lastrowid, "perf." + f, v)
+           for f, v in result.perf_stat.items()] +
+          [(cur.lastrowid, "rusage." + f, v)
+           for f, v in (result.rusage or {}).items()] +
+          [(cur.lastrowid, "metric." + f, v)
+           for f, v in (result.metrics or {}).items()])
+      self._maybe_commit()
+
+  def add_sys_stat(self, sys_stat):
+    rows = []
+    for prefix, stat, fields in zip(
+        ["cpu.", "mem.", "net."], sys_stat,
+        [CPU_STAT_FIELDS, MEM_STAT_FIELDS, NET_STAT_FIELDS]):
+      t = stat.time.timestamp()
+      rows += [(self.invocation_id, t, prefix + f, getattr(stat, f))
+               for f in fields]
+    with self.lock:
+      self.conn.executemany(
+          "INSERT INTO samples (invocation_id, time, name, value) "
+          "VALUES (?, ?, ?, ?)", rows)
+      self._maybe_commit()
+
+  def end(self, end_time, stats):
+    with self.lock:
+      self.conn.execute(
+          "UPDATE invocations SET end_time = ?, runs = ?, errors = ? "
+          "WHERE id = ?",
+          (end_time.timestamp(), stats.runs, stats.errors, self.invocation_id))
+      self.conn.commit()
+
+  def close(self):
+    with self.lock:
+      self.conn.commit()
+      self.conn.close()
+
+
+class TraceWriter:
+  # Writes runs and system samples as Chrome trace events (Perfetto can load
+  # it) incrementally. Each worker slot is a track of run slices and the
+  # system samples are counter tracks.
+  def __init__(self, path, tag):
+    self.start_time = None
+    self.f = open(path, "wt")
+    self.lock = threading.Lock()
+    self.slots = set()
+    self.first = True
+    self.f.write("[\n")
+    self._write({
+        "name": "process_name",
+        "ph": "M",
+        "pid": TRACE_PID,
+        "args": {
+            "name": "runs.py {0}".format(tag).strip()
+        }
+    })
+
+  def _ts(self, t):
+    return (t - self.start_time).total_seconds() * 1e6
+
+  def _write(self, event):
+    if not self.first:
+      self.f.write(",\n")
+    self.first = False
+    self.f.write(json.dumps(event))
+
+  def add_result(self, result):
+    args = {"code": result.code, "id": result.id}
+    if result.cpus:
+      args["cpus"] = ",".join(str(c) for c in result.cpus)
+    for prefix, values in [("perf.", result.perf_stat),
+                           ("rusage.", result.rusage),
+                           ("metric.", result.metrics)]:
+      for f, v in (values or {}).items():
+        args[prefix + f] = v
+    tid = result.slot + 1
+    with self.lock:
+      if result.slot not in self.slots:
+        self.slots.add(result.slot)
+        self._write({
+            "name": "thread_name",
+            "ph": "M",
+            "pid": TRACE_PID,
+            "tid": tid,
+            "args": {
+                "name": "slot {0}".format(result.slot)
+            }
+        })
+      if result.intended_time < result.start_time:
+        # Open-loop runs delayed by the harness overlap on async tracks
+        for ph, t in [("b", result.intended_time), ("e", result.start_time)]:
+          self._write({
+              "name": "queued",
+              "cat": "queue",
+              "ph": ph,
+              "id": result.id,
+              "pid": TRACE_PID,
+              "ts": self._ts(t)
+          })
+      self._write({
+          "name": "run" if result.code == 0 else "run (error)",
+          "cat": "run",
+          "ph": "X",
+          "pid": TRACE_PID,
+          "tid": tid,
+          "ts": self._ts(result.start_time),
+          "dur": self._ts(result.end_time) - self._ts(result.start_time),
+          "args": args
+      })
+
+  def add_sys_stat(self, sys_stat):
+    cpu_stat, mem_stat, net_stat = sys_stat
+    counters = [
+        ("CPU (%)", cpu_stat.time, {
+            "user": cpu_stat.user,
+            "system": cpu_stat.system,
+            "iowait": cpu_stat.iowait
+        }),
+        ("MEM used (KB)", mem_stat.time, {
+            "used": mem_stat.used
+        }),
+        ("NET (bytes/s)", net_stat.time, {
+            "in": net_stat.in_bandwith,
+            "out": net_stat.out_bandwith
+        }),
+    ]
+    with self.lock:
+      for name, t, values in counters:
+        self._write({
+            "name": name,
+            "ph": "C",
+            "pid": TRACE_PID,
+            "ts": self._ts(t),
+            "args": values
+        })
+
+  def close(self):
+    with self.lock:
+      self.f.write("\n]\n")
+      self.f.close()
+
+
+class LiveMetrics:
+  # Serves Prometheus text-format metrics of the ongoing run on localhost.
+  # The dispatcher only bumps counters and appends to a deque; percentiles
+  # are computed by the server thread when scraped.
+  def __init__(self, port, tag, window):
+    self.tag = tag
+    self.window = window
+    self.started = 0
+    self.completed = 0
+    self.errors = 0
+    self.recent = collections.deque()
+    self.sys_stat = None
+    live = self
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+      def do_GET(self):
+        body = live.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, format, *args):
+        pass
+
+    self.server = http.server.ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    self.server.daemon_threads = True
+    self._thread = threading.Thread(
+        target=self.server.serve_forever, daemon=True)
+
+  def start(self):
+    self._thread.start()
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+  def add_start(self):
+    self.started += 1
+
+  def discard_start(self):
+    # Warm-up runs are not reported
+    self.started -= 1
+
+  def add_result(self, result):
+    self.completed += 1
+    if result.code != 0:
+      self.errors += 1
+    now = time.monotonic()
+    self.recent.append(
+        (now, (result.end_time - result.start_time).total_seconds()))
+    while self.recent and self.recent[0][0] < now - self.window:
+      self.recent.popleft()
+
+  def add_sys_stat(self, sys_stat):
+    self.sys_stat = sys_stat
+
+  def render(self):
+    tag = self.tag.replace("\\", "\\\\").replace('"', '\\"').replace(
+        "\n", "\\n")
+    label = 'tag="{0}"'.format(tag)
+    lines = []
+
+    def add(name, metric_type, help_text, values):
+      lines.append("# HELP {0} {1}".format(name, help_text))
+      lines.append("# TYPE {0} {1}".format(name, metric_type))
+      for labels, v in values:
+        lines.append("{0}{{{1}}} {2}".format(name, ",".join([label] + labels),
+                                              v))
+
+    add("runs_completed_total", "counter", "Completed runs",
+        [([], self.completed)])
+    add("runs_errors_total", "counter", "Runs exited with non-zero",
+        [([], self.errors)])
+    add("runs_inflight", "gauge", "Runs in progress",
+        [([], self.started - self.completed)])
+    now = time.monotonic()
+    times = sorted(t for at, t in list(self.recent) if at >= now - self.window)
+    if times:
+      add("runs_time_seconds", "summary",
+          "Run time over the last {0:g} seconds".format(self.window),
+          [(['quantile="{0:g}"'.format(p / 100.0)], get_quantile(
+              times, p / 100.0)) for p in LIVE_METRICS_PERCENTILES])
+    sys_stat = self.sys_stat
+    if sys_stat:
+      cpu_stat, mem_stat, net_stat = sys_stat
+      add("runs_cpu_percent", "gauge", "The latest CPU usage",
+          [(['mode="{0}"'.format(f)], getattr(cpu_stat, f))
+           for f in CPU_STAT_FIELDS])
+      add("runs_mem_kilobytes", "gauge", "The latest memory usage",
+          [(['field="{0}"'.format(f)], getattr(mem_stat, f))
+           for f in MEM_STAT_FIELDS])
+      add("runs_net_bytes_per_second", "gauge", "The latest network bandwidth",
+          [(['direction="{0}"'.format(f.split("_")[0])], getattr(net_stat, f))
+           for f in NET_STAT_FIELDS])
+    return "\n".join(lines) + "\n"
+
+
+def has_pidfd():
+  # pidfd_open needs Linux 5.3 or later besides Python support
+  if not hasattr(os, "pidfd_open"):
+    return False
+  try:
+    os.close(os.pidfd_open(os.getpid()))
+  except OSError:
+    return False
+  return True
+
+
+class ChildWatcher:
+  def __init__(self):
+    self.selector = selectors.DefaultSelector()
+    self.children = {}
+    self.use_pidfd = has_pidfd()
+    self._wakeup_fd = None
+    if not self.use_pidfd:
+      # Falls back to SIGCHLD delivered through a self-pipe, which only the
+      # main thread can set up
+      r, w = os.pipe()
+      os.set_blocking(r, False)
+      os.set_blocking(w, False)
+      signal.set_wakeup_fd(w)
+      signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+      self._wakeup_fd = (r, w)
+      self.selector.register(r, selectors.EVENT_READ, None)
+
+  def __len__(self):
+    return len(self.children)
+
+  def add(self, proc, data, readers=None):
+    # readers maps a pipe fd of the child to a callback taking its output
+    pidfd = None
+    if self.use_pidfd:
+      pidfd = os.pidfd_open(proc.pid)
+      self.selector.register(pidfd, selectors.EVENT_READ, (proc.pid, None))
+    readers = dict(readers or {})
+    for fd, callback in readers.items():
+      os.set_blocking(fd, False)
+      self.selector.register(fd, selectors.EVENT_READ, (proc.pid, callback))
+    self.children[proc.pid] = (proc, data, pidfd, readers)
+
+  def _read(self, fd, callback):
+    # Returns True on data, False on EOF and None when nothing is ready
+    try:
+      chunk = os.read(fd, 1 << 16)
+    except BlockingIOError:
+      return None
+    if chunk:
+      callback(chunk)
+    return bool(chunk)
+
+  def _close_reader(self, pid, fd):
+    self.selector.unregister(fd)
+    os.close(fd)
+    del self.children[pid][3][fd]
+
+  def wait(self, timeout=None):
+    if not self.children and timeout is None:
+      return []
+    pids = []
+    for key, _ in self.selector.select(timeout):
+      if key.data is None:
+        try:
+          while os.read(key.fd, 4096):
+            pass
+        except BlockingIOError:
+          pass
+        pids = list(self.children.keys())
+        continue
+      pid, callback = key.data
+      if callback is None:
+        pids.append(pid)
+      elif self._read(key.fd, callback) is False:
+        self._close_reader(pid, key.fd)
+    done = []
+    for pid in pids:
+      if pid not in self.children:
+        continue
+      wpid, status, rusage = os.wait4(pid, os.WNOHANG)
+      if wpid == 0:
+        continue
+      proc, data, pidfd, readers = self.children[pid]
+      # Takes what is left in the pipes without waiting for EOF since
+      # descendants of the child may still hold them open.
+      for fd, callback in list(readers.items()):
+        while self._read(fd, callback):
+          pass
+        self._close_reader(pid, fd)
+      if pidfd is not None:
+        self.selector.unregister(pidfd)
+        os.close(pidfd)
+      del self.children[pid]
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      done.append((proc, data, rusage))
+    return done
+
+  def close(self):
+    for _, _, pidfd, readers in self.children.values():
+      for fd in [pidfd] + list(readers):
+        if fd is not None:
+          os.close(fd)
+    if self._wakeup_fd:
+      signal.set_wakeup_fd(-1)
+      signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+      for fd in self._wakeup_fd:
+        os.close(fd)
+    self.selector.close()
+
+
+class MetricCapture:
+  # Extracts user-defined metrics from the output of a run as it streams.
+  # A metric takes the last match in the output; its value is the group named
+  # "value", the first group or the whole match.
+  def __init__(self, metric_res, echo=False):
+    self.metric_res = metric_res
+    self.echo = echo
+    self.values = {}
+    self._partial = b""
+
+  def feed(self, chunk):
+    if self.echo:
+      sys.stdout.buffer.write(chunk)
+      sys.stdout.flush()
+    lines = (self._partial + chunk).split(b"\n")
+    self._partial = lines.pop()
+    for line in lines:
+      self._match(line)
+
+  def _match(self, line):
+    for name, metric_re in self.metric_res:
+      mo = metric_re.search(line)
+      if not mo:
+        continue
+      if "value" in metric_re.groupindex:
+        s = mo.group("value")
       else:
-        v = 0
-      f.write("\t{0:.2f}".format(v))
-    for field in NET_STAT_FIELDS:
-      if sys_stats:
-        values = [getattr(sys_stat[2], field) for sys_stat in sys_stats]
-        v = get_mid(values)
+        s = mo.group(1) if metric_re.groups else mo.group(0)
+      try:
+        self.values[name] = float(s)
+      except ValueError:
+        pass
+
+  def finish(self):
+    if self._partial:
+      self._match(self._partial)
+      self._partial = b""
+    return self.values
+
+
+def parse_metric(s):
+  name, sep, regex = s.partition("=")
+  if not sep or not name:
+    raise argparse.ArgumentTypeError("expected name=REGEX: " + s)
+  try:
+    return name, re.compile(regex.encode())
+  except re.error as e:
+    raise argparse.ArgumentTypeError("invalid regex {0}: {1}".format(regex, e))
+
+
+class RunCollector:
+  # Hands every result and system sample to the stats and the other sinks
+  # enabled by args as they come. Sinks are opened up front and begin() marks
+  # the start so that none of the setup time counts toward the runs.
+  def __init__(self, args, cmds):
+    self.args = args
+    self.cmds = cmds
+    self.overhead = get_calibrated_overhead(args) if args.calibration else None
+    self.stats = RunStats(
+        self.overhead if args.subtract_calibration and self.overhead else 0)
+    self.sinks = [self.stats]
+    self.store = None
+    if args.result_db:
+      self.store = ResultStore(args.result_db)
+      self.sinks.append(self.store)
+    self.trace = None
+    if args.trace:
+      self.trace = TraceWriter(args.trace, args.report_tag)
+      self.sinks.append(self.trace)
+    self.live = None
+    if args.metrics_port:
+      try:
+        self.live = LiveMetrics(args.metrics_port, args.report_tag,
+                                args.metrics_window)
+      except OSError as e:
+        print(e)
       else:
-        v = 0
-      f.write("\t{0:.2f}".format(v))
-    f.write("\n")
+        self.live.start()
+        self.sinks.append(self.live)
+    self.sampler = None
 
+  def begin(self, start_time):
+    if self.store:
+      self.store.begin(start_time, self.args, self.cmds)
+    if self.trace:
+      self.trace.start_time = start_time
+    if self.args.sample_rate > 0:
+      self.sampler = SysSampler(self.args.sample_rate, self.add_sys_stat)
+      if not self.sampler.start():
+        self.sampler = None
 
-def run(args, cmds):
-  processes = []
-  results = []
-  sys_stats = []
-  cpu_stats_proc = init_cpu_stat_proc()
-  net_stats_proc = init_net_stat_proc()
+  def add_result(self, result):
+    for sink in self.sinks:
+      sink.add_result(result)
+
+  def add_sys_stat(self, sys_stat):
+    for sink in self.sinks:
+      sink.add_sys_stat(sys_stat)
+
+  def close(self, end_time):
+    if self.sampler:
+      self.sampler.stop()
+    if self.store:
+      self.store.end(end_time, self.stats)
+      self.store.close()
+    if self.live:
+      self.live.stop()
+    if self.trace:
+      self.trace.close()
+
+
+def parse_cpu_list(s):
+  cpus = set()
+  for r in s.strip().split(","):
+    if not r:
+      continue
+    lo, _, hi = r.partition("-")
+    cpus.update(range(int(lo), int(hi or lo) + 1))
+  return sorted(cpus)
+
+
+def get_numa_nodes(cpus):
+  nodes = []
+  for path in sorted(glob.glob("/sys/devices/system/node/node*/cpulist")):
+    with open(path) as f:
+      node_cpus = [c for c in parse_cpu_list(f.read()) if c in cpus]
+    if node_cpus:
+      nodes.append(node_cpus)
+  return nodes or [cpus]
+
+
+def build_cpu_pinning(args, slots):
+  # Returns a function mapping a worker slot to its CPUs or None
+  if args.pin == "none":
+    return None
+  cpus = parse_cpu_list(args.cpus) if args.cpus else sorted(
+      os.sched_getaffinity(0))
+  if args.pin == "list":
+    return lambda slot: cpus
+  if args.pin == "numa":
+    nodes = get_numa_nodes(cpus)
+    return lambda slot: nodes[slot % len(nodes)]
+  # Gives each slot an exclusive set of cores as long as there are enough
+  n = max(len(cpus) // max(slots, 1), 1)
+  return lambda slot: [cpus[(slot * n + i) % len(cpus)] for i in range(n)]
+
+
+def spawn_run(args, cmds, run_id, slot=0, cpus=None):
+  argv = cmds
+  pass_fds = ()
+  readers = {}
+  perf_output = bytearray()
+  if not args.no_perf:
+    # perf stat writes its CSV output to a pipe given by --log-fd
+    r, w = os.pipe()
+    perf_events_argv = ["-e", args.perf_events] if args.perf_events else []
+    argv = ["perf", "stat", "-x", PERF_CSV_SEP, "--log-fd",
+            str(w)] + perf_events_argv + ["--"] + cmds
+    pass_fds = (w,)
+    readers[r] = perf_output.extend
+  stdout = None
+  capture = None
+  if args.metric:
+    # The output is read through a non-blocking pipe by the dispatcher
+    r, stdout = os.pipe()
+    capture = MetricCapture(args.metric, args.verbose)
+    readers[r] = capture.feed
+  p_env = os.environ.copy()
+  p_env['RUN_PROCESS_ID'] = str(run_id)
+  p_env['RUN_SLOT_ID'] = str(slot)
+  if cpus:
+    # taskset pins before perf forks the command, and unlike preexec_fn it
+    # keeps Popen on its fast spawn path while other threads run
+    argv = ["taskset", "-c", ",".join(str(c) for c in cpus)] + argv
+  try:
+    p = subprocess.Popen(argv, env=p_env, stdout=stdout, pass_fds=pass_fds)
+  finally:
+    for fd in pass_fds + ((stdout,) if stdout is not None else ()):
+      os.close(fd)
+  return p, readers, perf_output, capture
+
+
+def dispatch(args, cmds):
+  check_perf(args)
+  collector = RunCollector(args, cmds)
+  stats = collector.stats
+  live = collector.live
+  watcher = ChildWatcher()
+  # Open-loop runs start on a fixed schedule and closed-loop runs start
+  # whenever one of the threads becomes free.
+  interval = 1.0 / args.rate if args.rate else None
+  max_inflight = args.max_inflight if args.rate else args.threads
+  # Worker slots are reused lowest first to keep their CPUs stable
+  free_slots = []
+  next_slot = 0
+  get_slot_cpus = build_cpu_pinning(args, max_inflight)
+  # With --target_ci, --runs is the minimum and runs are added until the
+  # confidence interval is narrow enough or --max_runs is reached.
+  max_runs = max(args.runs, args.max_runs) if args.target_ci else args.runs
+  converged = False
+  completed = 0
+  # The open-loop schedule and intended times share this one starting point
   start_time = datetime.datetime.now()
+  start_clock = time.monotonic()
+  collector.begin(start_time)
   # Dispatching processes running cmd
-  last_proc_id = 0
-  while len(results) < args.runs:
-    for i in range(len(processes) - 1, -1, -1):
-      p = processes[i][0]
-      if p.poll() != None:
-        now = datetime.datetime.now()
-        start_time = processes[i][1]
-        perf_stat_file = processes[i][2]
-        with open(perf_stat_file, 'r') as f:
-          perf_stat = parse_perf_stat_output(f.read())
-        if perf_stat:
-          os.remove(perf_stat_file)
-        if args.verbose:
-          print("Done: Code={0} Elapsed={1}".format(p.poll(), now - start_time))
-        results.append((p.poll(), start_time, now, perf_stat))
-        del processes[i]
-    while len(
-        processes) < args.threads and len(processes) + len(results) < args.runs:
+  started = 0
+  while len(watcher) > 0 or not (converged or
+                                 started >= args.warmup + max_runs):
+    timeout = None
+    while not converged and started < args.warmup + max_runs and (
+        max_inflight <= 0 or len(watcher) < max_inflight):
+      intended_time = None
+      if interval:
+        delay = start_clock + started * interval - time.monotonic()
+        if delay > 0:
+          timeout = delay
+          break
+        intended_time = start_time + datetime.timedelta(
+            seconds=started * interval)
       if args.verbose:
         print("Run")
-      perf_stat_file = tempfile.mkstemp(prefix="runs_perf_")[1]
-      last_proc_id += 1
-      p_env = os.environ.copy()
-      p_env['RUN_PROCESS_ID'] = str(last_proc_id)
-      p = subprocess.Popen(["perf", "stat", "-o", perf_stat_file] + cmds, env=p_env)
-      processes.append((p, datetime.datetime.now(), perf_stat_file))
-    # Collect system stats
-    if cpu_stats_proc.poll() != None and net_stats_proc.poll() != None:
-      cpu_stat = get_cpu_stat(cpu_stats_proc)
-      mem_stat = get_mem_stat()
-      net_stat = get_net_stat(net_stats_proc)
-      if cpu_stat and mem_stat and net_stat:
-        sys_stats.append((cpu_stat, mem_stat, net_stat))
-      cpu_stats_proc = init_cpu_stat_proc()
-      net_stats_proc = init_net_stat_proc()
-    time.sleep(0.01)
-  # Reports when done
+      started += 1
+      if free_slots:
+        slot = heapq.heappop(free_slots)
+      else:
+        slot = next_slot
+        next_slot += 1
+      cpus = get_slot_cpus(slot) if get_slot_cpus else None
+      p, readers, perf_output, capture = spawn_run(args, cmds, started, slot,
+                                                   cpus)
+      run_start_time = datetime.datetime.now()
+      if live:
+        live.add_start()
+      watcher.add(p, (started, intended_time or run_start_time,
+                      run_start_time, perf_output, capture, slot, cpus),
+                  readers)
+    for p, (run_id, intended_time, run_start_time, perf_output, capture, slot,
+            cpus), rusage in watcher.wait(timeout):
+      heapq.heappush(free_slots, slot)
+      now = datetime.datetime.now()
+      perf_stat = parse_perf_stat_csv(perf_output.decode('utf-8', 'replace'))
+      metrics = capture.finish() if capture else {}
+      if args.bytes_per_run and p.returncode == 0 and now > run_start_time:
+        metrics["MBps"] = args.bytes_per_run / MB / (
+            now - run_start_time).total_seconds()
+      if args.verbose:
+        print("Done: Code={0} Elapsed={1}".format(p.returncode,
+                                                  now - run_start_time))
+      completed += 1
+      if completed <= args.warmup:
+        if live:
+          live.discard_start()
+        continue
+      result = RunResult(
+          run_id,
+          p.returncode,
+          intended_time,
+          run_start_time,
+          now,
+          perf_stat,
+          slot=slot,
+          cpus=cpus,
+          rusage=get_rusage_stat(rusage),
+          metrics=metrics)
+      collector.add_result(result)
+      if stats.runs >= args.runs and not converged:
+        converged = not args.target_ci or stats.is_converged(
+            "Run", "time", args.ci_percentile, args.target_ci)
+        if converged and args.target_ci:
+          stats.converged_runs = stats.runs
   end_time = datetime.datetime.now()
+  watcher.close()
+  collector.close(end_time)
+  return start_time, end_time, stats
+
+
+def load_callable(spec):
+  module_name, _, func_name = spec.partition(":")
+  if os.getcwd() not in sys.path:
+    sys.path.insert(0, os.getcwd())
+  module = importlib.import_module(module_name)
+  return functools.reduce(getattr, func_name.split("."), module)
+
+
+def callable_worker(spec, slot, iterations, cpus, ready, go, out):
+  # Runs in a warm worker thread or process. Timings are sent back in
+  # batches of (start_ns, end_ns, code) by size or by time.
+  if cpus:
+    os.sched_setaffinity(0, cpus)
+  try:
+    func = load_callable(spec)
+  except Exception as e:
+    # Reported through ready so the parent never waits on a dead worker
+    ready.put((slot, os.getpid(), threading.get_native_id(), repr(e)))
+    return
+  ready.put((slot, os.getpid(), threading.get_native_id(), None))
+  go.wait()
+  batch = []
+  interval_ns = int(CALLABLE_BATCH_INTERVAL * 1e9)
+  batch_start = time.perf_counter_ns()
+  for _ in range(iterations):
+    t0 = time.perf_counter_ns()
+    try:
+      func()
+      code = 0
+    except Exception:
+      code = 1
+    t1 = time.perf_counter_ns()
+    batch.append((t0, t1, code))
+    if len(batch) >= CALLABLE_BATCH_SIZE or t1 - batch_start >= interval_ns:
+      out.put((slot, batch))
+      batch = []
+      batch_start = t1
+  out.put((slot, batch))
+  out.put((slot, None))
+
+
+def start_perf_attach(args, target_args):
+  r, w = os.pipe()
+  perf_events_argv = ["-e", args.perf_events] if args.perf_events else []
+  try:
+    p = subprocess.Popen(
+        ["perf", "stat", "-x", PERF_CSV_SEP, "--log-fd",
+         str(w)] + perf_events_argv + target_args,
+        pass_fds=(w,))
+  finally:
+    os.close(w)
+  return p, r
+
+
+def dispatch_callable(args):
+  check_perf(args)
+  if args.pool == "process":
+    context = multiprocessing.get_context()
+    ready, go, out = context.Queue(), context.Event(), context.Queue()
+    new_worker = lambda *a: context.Process(target=callable_worker, args=a)
+  else:
+    ready, go, out = queue.SimpleQueue(), threading.Event(), queue.SimpleQueue()
+    new_worker = lambda *a: threading.Thread(target=callable_worker, args=a)
+  get_slot_cpus = build_cpu_pinning(args, args.threads)
+  total = args.warmup + args.runs
+  workers = []
+  for slot in range(args.threads):
+    iterations = total // args.threads + (1 if slot < total % args.threads else
+                                          0)
+    cpus = get_slot_cpus(slot) if get_slot_cpus else None
+    worker = new_worker(args.callable, slot, iterations, cpus, ready, go, out)
+    worker.daemon = True
+    worker.start()
+    workers.append((worker, cpus, iterations))
+  # Attaches a long-lived perf stat to each worker before they start
+  perfs = {}
+  errors = []
+  for _ in workers:
+    slot, pid, tid, error = ready.get()
+    if error:
+      errors.append("slot {0}: {1}".format(slot, error))
+    elif not args.no_perf:
+      target = ["-p", str(pid)] if args.pool == "process" else ["-t", str(tid)]
+      perfs[slot] = start_perf_attach(args, target)
+  if errors:
+    for p, r in perfs.values():
+      p.kill()
+      p.wait()
+      os.close(r)
+    raise RuntimeError("cannot load --callable {0}: {1}".format(
+        args.callable, "; ".join(errors)))
+  if perfs:
+    time.sleep(CALLABLE_PERF_ATTACH_DELAY)
+  collector = RunCollector(args, [args.callable])
+  start_time = datetime.datetime.now()
+  base_ns = time.perf_counter_ns()
+  to_datetime = lambda ns: start_time + datetime.timedelta(
+      microseconds=(ns - base_ns) / 1000)
+  collector.begin(start_time)
+  # Every worker has one iteration in flight until it is done
+  live = collector.live
+  done = [0] * len(workers)
+  if live:
+    for _, _, iterations in workers:
+      if iterations:
+        live.add_start()
+  go.set()
+  completed = 0
+  running = len(workers)
+  while running > 0:
+    slot, batch = out.get()
+    if batch is None:
+      running -= 1
+      continue
+    for t0, t1, code in batch:
+      completed += 1
+      done[slot] += 1
+      if live and done[slot] < workers[slot][2]:
+        live.add_start()
+      if completed <= args.warmup:
+        if live:
+          live.discard_start()
+        continue
+      t = to_datetime(t0)
+      collector.add_result(
+          RunResult(
+              completed - args.warmup,
+              code,
+              t,
+              t,
+              to_datetime(t1),
+              {},
+              slot=slot,
+              cpus=workers[slot][1]))
+  end_time = datetime.datetime.now()
+  for slot, (p, r) in perfs.items():
+    p.send_signal(signal.SIGINT)
+    p.wait()
+    output = bytearray()
+    os.set_blocking(r, False)
+    try:
+      while True:
+        chunk = os.read(r, 1 << 16)
+        if not chunk:
+          break
+        output.extend(chunk)
+    except BlockingIOError:
+      pass
+    os.close(r)
+    # Per-worker totals are reported per iteration of the worker
+    iterations = workers[slot][2]
+    for f, v in parse_perf_stat_csv(output.decode('utf-8', 'replace')).items():
+      collector.stats.add("Perf", f, v / max(iterations, 1))
+  for worker, _, _ in workers:
+    worker.join()
+  collector.close(end_time)
+  return start_time, end_time, collector.stats
+
+
+def run(args, cmds):
+  if args.callable:
+    start_time, end_time, stats = dispatch_callable(args)
+  else:
+    start_time, end_time, stats = dispatch(args, cmds)
+  # Reports when done
   if args.stats:
-    print_stats(start_time, end_time, results, sys_stats)
+    print_stats(start_time, end_time, stats, args)
   if args.report_file:
-    write_report(start_time, end_time, results, sys_stats, args)
+    write_report(start_time, end_time, stats, args)
 
 
-def main():
+def load_sweep_spec(path):
+  with open(path) as f:
+    if path.endswith((".yaml", ".yml")):
+      if yaml is None:
+        raise RuntimeError("PyYAML is required to read " + path)
+      return yaml.safe_load(f)
+    return json.load(f)
+
+
+def get_axis_value_name(value):
+  return value.get("name") if isinstance(value, dict) else value
+
+
+def is_excluded(cell, excludes):
+  for exclude in excludes:
+    if all(
+        get_axis_value_name(cell[axis]) in (v if isinstance(v, list) else [v])
+        for axis, v in exclude.items()):
+      return True
+  return False
+
+
+def resolve_sweep_variables(variables):
+  # Axis and var values may be templates of other variables. Each one is
+  # formatted once, after the ones it refers to, so {{ }} stays literal.
+  resolved = {}
+
+  def resolve(name, depth):
+    if name in resolved:
+      return resolved[name]
+    if depth > SWEEP_MAX_FORMAT_DEPTH:
+      raise ValueError("sweep variable {0} nests too deep".format(name))
+    value = variables[name]
+    if isinstance(value, str):
+      refs = set(
+          re.match(r"\w*", field).group()
+          for _, field, _, _ in string.Formatter().parse(value)
+          if field)
+      value = value.format(
+          **{ref: resolve(ref, depth + 1) for ref in refs if ref in variables})
+    resolved[name] = value
+    return value
+
+  for name in variables:
+    resolve(name, 0)
+  return resolved
+
+
+def format_sweep_value(value, variables):
+  # Formats once with the resolved variables, then expands $VARS
+  if not isinstance(value, str):
+    return value
+  return os.path.expandvars(value.format(**variables))
+
+
+def build_sweep_cells(spec):
+  axes = spec.get("axes", {})
+  excludes = list(spec.get("exclude", []))
+  for values in axes.values():
+    for value in values:
+      if isinstance(value, dict) and "exclude" in value:
+        excludes.append(
+            dict(value["exclude"], **{
+                axis: value["name"]
+                for axis, vs in axes.items()
+                if value in vs
+            }))
+  cells = []
+  for i in range(spec.get("repeat", 1)):
+    for values in itertools.product(*axes.values()):
+      cell = dict(zip(axes.keys(), values))
+      if is_excluded(cell, excludes):
+        continue
+      key = dict({"iteration": i},
+                 **{axis: get_axis_value_name(v) for axis, v in cell.items()})
+      variables = resolve_sweep_variables(
+          dict(spec.get("vars", {}), iteration=i, **cell))
+      options = dict(spec.get("options", {}))
+      for v in values:
+        if isinstance(v, dict):
+          options.update(v.get("options", {}))
+      argv = []
+      for name, value in options.items():
+        value = format_sweep_value(value, variables)
+        if value is True:
+          argv.append("--" + name)
+        elif value is not False and value is not None:
+          argv += ["--" + name, str(value)]
+      cmds = shlex.split(format_sweep_value(spec["command"], variables))
+      cells.append((json.dumps(key, sort_keys=True), argv, cmds))
+  return cells
+
+
+def sweep(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py sweep",
+      description='Runs all cells of a parameter sweep spec (JSON or YAML)')
+  parser.add_argument('spec', help="The path of the sweep spec")
+  parser.add_argument(
+      '--checkpoint',
+      help="The file recording finished cells (default: <spec>.done)")
+  parser.add_argument(
+      '--parallel',
+      type=int,
+      default=1,
+      help="The number of cells to run at the same time")
+  parser.add_argument(
+      '--seed', type=int, help="The seed for shuffling the order of cells")
+  parser.add_argument(
+      '--dry_run',
+      action="store_true",
+      help="Print the cells to run without running them")
+  my_args = parser.parse_args(argv)
+  if my_args.parallel > 1 and not has_pidfd():
+    parser.error("--parallel needs pidfd_open (Linux 5.3 or later)")
+  spec = load_sweep_spec(my_args.spec)
+  checkpoint = os.path.abspath(my_args.checkpoint or my_args.spec + ".done")
+  done = set()
+  if os.path.exists(checkpoint):
+    with open(checkpoint) as f:
+      done = set(l.strip() for l in f if l.strip())
+  cells = [c for c in build_sweep_cells(spec) if c[0] not in done]
+  # Interleaves configurations to spread environmental drift over all cells
+  random.Random(my_args.seed).shuffle(cells)
+  print("Sweep: {0} cells to run, {1} done".format(len(cells), len(done)))
+  os.chdir(
+      os.path.join(
+          os.path.dirname(os.path.abspath(my_args.spec)), spec.get("cwd", ".")))
+  parser = build_parser()
+  lock = threading.Lock()
+
+  def run_cell(cell):
+    key, cell_argv, cmds = cell
+    print("Cell: {0} {1} -- {2}".format(key, " ".join(cell_argv),
+                                        " ".join(cmds)))
+    if my_args.dry_run:
+      return
+    run(parser.parse_args(cell_argv), cmds)
+    with lock:
+      with open(checkpoint, "at") as f:
+        f.write(key + "\n")
+
+  if my_args.parallel > 1:
+    with concurrent.futures.ThreadPoolExecutor(my_args.parallel) as executor:
+      for _ in executor.map(run_cell, cells):
+        pass
+  else:
+    for cell in cells:
+      run_cell(cell)
+
+
+def parse_date(s):
+  return datetime.datetime.fromisoformat(s).timestamp()
+
+
+def add_run_filter_arguments(parser):
+  parser.add_argument('--db', required=True, help="The path of the result db")
+  parser.add_argument('--tag', help="Only runs with this tag")
+  parser.add_argument('--threads', type=int, help="Only runs with this threads")
+  parser.add_argument(
+      '--since', type=parse_date, help="Only runs started since (ISO date)")
+  parser.add_argument(
+      '--until', type=parse_date, help="Only runs started before (ISO date)")
+  parser.add_argument(
+      '--metric',
+      default="time",
+      help="The metric of runs (time, response_time or e.g. perf.cycles)")
+
+
+def query_run_values(conn, args, group_by=()):
+  # Yields (group, code, value) of matching runs straight from the cursor
+  columns = {
+      "tag": "i.tag",
+      "threads": "i.threads",
+      "host": "i.host",
+      "invocation": "i.id",
+      "date": "date(r.start_time, 'unixepoch', 'localtime')",
+  }
+  conds = []
+  params = []
+  if args.tag is not None:
+    conds.append("i.tag = ?")
+    params.append(args.tag)
+  if args.threads is not None:
+    conds.append("i.threads = ?")
+    params.append(args.threads)
+  if args.since is not None:
+    conds.append("r.start_time >= ?")
+    params.append(args.since)
+  if args.until is not None:
+    conds.append("r.start_time < ?")
+    params.append(args.until)
+  if args.metric in RESULT_DB_RUN_METRICS:
+    value = "r." + args.metric
+    join = ""
+  else:
+    value = "m.value"
+    join = "JOIN run_metrics m ON m.run = r.id AND m.name = ?"
+    params.insert(0, args.metric)
+  group = [columns[g] for g in group_by] or ["NULL"]
+  sql = ("SELECT {0}, r.code, {1} FROM runs r "
+         "JOIN invocations i ON r.invocation_id = i.id {2} {3}").format(
+             ", ".join(group), value, join,
+             "WHERE " + " AND ".join(conds) if conds else "")
+  for row in conn.execute(sql, params):
+    yield row[:-2], row[-2], row[-1]
+
+
+def open_result_db(path):
+  return sqlite3.connect("file:{0}?mode=ro".format(path), uri=True)
+
+
+def query(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py query", description='Shows percentiles of stored runs')
+  add_run_filter_arguments(parser)
+  parser.add_argument(
+      '--group_by',
+      default="tag,threads",
+      help="The comma-separated columns among tag,threads,host,invocation,date")
+  parser.add_argument(
+      "-p",
+      "--percentiles",
+      type=parse_percentiles,
+      default=PERCENTILES,
+      help="The comma-separated percentiles to report")
+  args = parser.parse_args(argv)
+  group_by = [g for g in args.group_by.split(",") if g]
+  groups = {}
+  conn = open_result_db(args.db)
+  for group, code, value in query_run_values(conn, args, group_by):
+    stats = groups.get(group)
+    if stats is None:
+      stats = groups[group] = RunStats()
+    stats.runs += 1
+    if code != 0:
+      stats.errors += 1
+    stats.add("Run", args.metric, value)
+  conn.close()
+  print("\t".join(group_by + ["Runs", "Errors"] +
+                  ["P" + format_percentile(p) for p in args.percentiles]))
+  for group in sorted(groups, key=lambda g: [str(v) for v in g]):
+    stats = groups[group]
+    print("\t".join([str(v) for v in group[:len(group_by)]] +
+                    [str(stats.runs), str(stats.errors)] + [
+                        "{0:.4g}".format(stats.quantile("Run", args.metric, p))
+                        for p in args.percentiles
+                    ]))
+
+
+def get_quantile(sorted_values, q):
+  return sorted_values[min(int(len(sorted_values) * q), len(sorted_values) - 1)]
+
+
+def get_mean(values):
+  return sum(values) / len(values) if values else 0
+
+
+def mann_whitney_u(a, b):
+  # Returns U of a and the two-sided p-value from the normal approximation
+  # with the tie correction.
+  values = sorted([(v, 0) for v in a] + [(v, 1) for v in b])
+  n1, n2 = len(a), len(b)
+  n = n1 + n2
+  rank_sum = 0
+  tie_term = 0
+  i = 0
+  while i < n:
+    j = i
+    while j < n and values[j][0] == values[i][0]:
+      j += 1
+    rank = (i + j + 1) / 2.0
+    rank_sum += rank * sum(1 for k in range(i, j) if values[k][1] == 0)
+    tie_term += (j - i)**3 - (j - i)
+    i = j
+  u = rank_sum - n1 * (n1 + 1) / 2.0
+  mu = n1 * n2 / 2.0
+  sigma = math.sqrt(n1 * n2 / 12.0 * ((n + 1) - tie_term / (n * (n - 1))))
+  if sigma == 0:
+    return u, 1.0
+  z = (abs(u - mu) - 0.5) / sigma
+  return u, math.erfc(max(z, 0) / math.sqrt(2))
+
+
+def bootstrap_diff_ci(a, b, estimator, iterations, rng):
+  # 95% percentile-bootstrap CI of the relative difference (b - a) / a
+  diffs = []
+  for _ in range(iterations):
+    ea = estimator(sorted(rng.choices(a, k=len(a))))
+    eb = estimator(sorted(rng.choices(b, k=len(b))))
+    if ea:
+      diffs.append((eb - ea) / ea)
+  diffs.sort()
+  if not diffs:
+    return 0, 0
+  return get_quantile(diffs, 0.025), get_quantile(diffs, 0.975)
+
+
+def load_compare_values(conn, selector, args):
+  # selector is either TAG, TAG:THREADS or @INVOCATION_ID
+  filter_args = argparse.Namespace(**vars(args))
+  filter_args.tag = None
+  filter_args.threads = None
+  group_by = ()
+  if selector.startswith("@"):
+    group_by = ("invocation",)
+    want = (int(selector[1:]),)
+  else:
+    tag, _, threads = selector.partition(":")
+    filter_args.tag = tag
+    if threads:
+      filter_args.threads = int(threads)
+    want = None
+  return [
+      value
+      for group, code, value in query_run_values(conn, filter_args, group_by)
+      if code == 0 and value is not None and (want is None or group == want)
+  ]
+
+
+def load_compare_throughputs(conn, selector, args):
+  # Successful runs per second of each matching invocation's elapsed time
+  conds = []
+  params = []
+  if selector.startswith("@"):
+    conds.append("i.id = ?")
+    params.append(int(selector[1:]))
+  else:
+    tag, _, threads = selector.partition(":")
+    conds.append("i.tag = ?")
+    params.append(tag)
+    if threads:
+      conds.append("i.threads = ?")
+      params.append(int(threads))
+  if args.since is not None:
+    conds.append("i.start_time >= ?")
+    params.append(args.since)
+  if args.until is not None:
+    conds.append("i.start_time < ?")
+    params.append(args.until)
+  sql = ("SELECT i.start_time, i.end_time, SUM(r.code = 0) FROM invocations i "
+         "JOIN runs r ON r.invocation_id = i.id WHERE {0} "
+         "GROUP BY i.id").format(" AND ".join(conds))
+  return [
+      runs / (end_time - start_time)
+      for start_time, end_time, runs in conn.execute(sql, params)
+      if end_time is not None and end_time > start_time
+  ]
+
+
+def compare(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py compare",
+      description='Compares runs of A (baseline) and B. Exits with 1 when B '
+      'regresses beyond the threshold in any of the gated stats.')
+  parser.add_argument('a', help="The baseline runs (TAG, TAG:THREADS or @ID)")
+  parser.add_argument('b', help="The runs to compare (TAG, TAG:THREADS or @ID)")
+  parser.add_argument('--db', required=True, help="The path of the result db")
+  parser.add_argument(
+      '--since', type=parse_date, help="Only runs started since (ISO date)")
+  parser.add_argument(
+      '--until', type=parse_date, help="Only runs started before (ISO date)")
+  parser.add_argument(
+      '--metric',
+      default="time",
+      help="The metric of runs (time, response_time or e.g. perf.cycles)")
+  parser.add_argument(
+      '--higher_is_better',
+      action="store_true",
+      help="The metric gets better as it grows (e.g. throughput)")
+  parser.add_argument(
+      '--threshold',
+      type=float,
+      default=5,
+      help="The change in percent of a gated stat that counts as a regression")
+  parser.add_argument(
+      '--gate',
+      type=lambda s: [g for g in s.split(",") if g],
+      default=COMPARE_STATS,
+      help="The comma-separated stats that can fail the comparison among "
+      "p50,p99,runs/sec (default: all). p50 and p99 must also pass the "
+      "Mann-Whitney test and runs/sec its bootstrap CI")
+  parser.add_argument(
+      '--alpha',
+      type=float,
+      default=0.05,
+      help="The significance level of the Mann-Whitney test")
+  parser.add_argument(
+      '--bootstrap',
+      type=int,
+      default=1000,
+      help="The number of bootstrap resamples")
+  parser.add_argument('--seed', type=int, help="The seed for bootstrapping")
+  args = parser.parse_args(argv)
+  unknown = [g for g in args.gate if g not in COMPARE_STATS]
+  if unknown:
+    parser.error("unknown --gate stats: " + ",".join(unknown))
+  conn = open_result_db(args.db)
+  a = load_compare_values(conn, args.a, args)
+  b = load_compare_values(conn, args.b, args)
+  ta = load_compare_throughputs(conn, args.a, args)
+  tb = load_compare_throughputs(conn, args.b, args)
+  conn.close()
+  if len(a) < 2 or len(b) < 2:
+    print("Not enough successful runs: A={0} B={1}".format(len(a), len(b)))
+    return 2
+  rng = random.Random(args.seed)
+  print("A: {0} ({1} runs) B: {2} ({3} runs) metric: {4}".format(
+      args.a, len(a), args.b, len(b), args.metric))
+  print("\t".join(["stat", "A", "B", "diff", "diff-95%-CI"]))
+  estimators = [("p50", a, b, lambda v: get_quantile(v, 0.5)),
+                ("p99", a, b, lambda v: get_quantile(v, 0.99))]
+  # Throughput is resampled by invocation, as runs of one invocation share
+  # its elapsed time
+  if ta and tb:
+    estimators.append(("runs/sec", ta, tb, get_mean))
+  diffs = {}
+  for name, va, vb, estimator in estimators:
+    ea, eb = estimator(sorted(va)), estimator(sorted(vb))
+    diff = (eb - ea) / ea if ea else 0
+    lo, hi = bootstrap_diff_ci(va, vb, estimator, args.bootstrap, rng)
+    diffs[name] = (diff, lo, hi)
+    print("{0}\t{1:.4g}\t{2:.4g}\t{3:+.2f}%\t[{4:+.2f}%, {5:+.2f}%]".format(
+        name, ea, eb, diff * 100, lo * 100, hi * 100))
+  u, p_value = mann_whitney_u(a, b)
+  # Cliff's delta, the probability of B > A minus that of B < A
+  delta = 1 - 2 * u / (len(a) * len(b))
+  print("Mann-Whitney U: {0:.1f} p-value: {1:.4g} Cliff's delta: {2:+.3f}"
+        .format(u, p_value, delta))
+  regressed = False
+  for name in args.gate:
+    if name not in diffs:
+      continue
+    diff, lo, hi = diffs[name]
+    # Fewer runs/sec is worse whatever the metric
+    if name == "runs/sec" or args.higher_is_better:
+      diff, lo, hi = -diff, -hi, -lo
+    significant = lo > 0 if name == "runs/sec" else p_value < args.alpha
+    if diff * 100 > args.threshold and significant:
+      print("REGRESSION: {0} is {1:.2f}% worse (threshold {2}%)".format(
+          name, diff * 100, args.threshold))
+      regressed = True
+  return 1 if regressed else 0
+
+
+def measure_overhead(threads, runs, cmds, no_perf=True):
+  argv = ["-r", str(runs), "-t", str(threads), "--sample_rate", "0"]
+  if no_perf:
+    argv.append("--no_perf")
+  args = build_parser().parse_args(argv)
+  start_time, end_time, stats = dispatch(args, cmds)
+  elapsed = (end_time - start_time).total_seconds()
+  busy = stats.groups["Run"]["time"].sum
+  return {
+      "elapsed": elapsed,
+      "runs": stats.runs,
+      "p50": stats.quantile("Run", "time", 50),
+      "p99": stats.quantile("Run", "time", 99),
+      # Time each worker slot spent outside of a child
+      "dispatch": (elapsed * threads - busy) / stats.runs,
+  }
+
+
+def selftest(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py selftest",
+      description='Measures the dispatch overhead of runs.py with `true`')
+  parser.add_argument(
+      '-r', '--runs', help="The number of runs", type=int, default=2000)
+  parser.add_argument(
+      '-t',
+      '--threads',
+      help="The comma-separated list of concurrencies",
+      type=str,
+      default="1,64")
+  my_args = parser.parse_args(argv)
+  for threads in [int(t) for t in my_args.threads.split(",")]:
+    m = measure_overhead(threads, my_args.runs, ["true"])
+    print("Threads: {0} Runs: {1} Elapsed: {2:.3f} sec ({3:.0f} runs/sec)"
+          .format(threads, m["runs"], m["elapsed"], m["runs"] / m["elapsed"]))
+    print("  Run p50: {0:.1f} us p99: {1:.1f} us".format(
+        m["p50"] * 1e6, m["p99"] * 1e6))
+    print("  Dispatch overhead per run: {0:.1f} us".format(m["dispatch"] * 1e6))
+
+
+def fit_line(xs, ys):
+  # Least-squares fit of y = a + b * x
+  n = len(xs)
+  mx, my = sum(xs) / n, sum(ys) / n
+  sxx = sum((x - mx)**2 for x in xs)
+  b = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx if sxx else 0
+  return my - b * mx, b
+
+
+def calibrate(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py calibrate",
+      description='Measures the overhead runs.py adds to every run with null '
+      'commands and stores it as a calibration profile')
+  parser.add_argument(
+      '-r', '--runs', help="The number of runs", type=int, default=500)
+  parser.add_argument(
+      '-t',
+      '--threads',
+      help="The comma-separated list of concurrencies",
+      type=str,
+      default="1,2,4,8,16,32,64")
+  parser.add_argument(
+      '-o',
+      '--output',
+      default=CALIBRATION_FILE,
+      help="The path of the calibration profile")
+  my_args = parser.parse_args(argv)
+  threads_list = [int(t) for t in my_args.threads.split(",")]
+  modes = ["no_perf"] + (["perf"] if shutil.which("perf") else [])
+  profile = {
+      "host": socket.gethostname(),
+      "time": datetime.datetime.now().isoformat(),
+      "modes": {}
+  }
+  for mode in modes:
+    commands = {}
+    for name, cmds in CALIBRATION_COMMANDS:
+      ms = {}
+      for threads in threads_list:
+        m = measure_overhead(threads, my_args.runs, cmds, mode == "no_perf")
+        ms[str(threads)] = m
+        print("{0} {1} threads={2}: p50 {3} p99 {4} dispatch {5}".format(
+            mode, name, threads, format_seconds(m["p50"]),
+            format_seconds(m["p99"]), format_seconds(m["dispatch"])))
+      fixed, per_thread = fit_line(threads_list,
+                                   [ms[str(t)]["p50"] for t in threads_list])
+      commands[name] = {
+          "threads": ms,
+          "fixed": fixed,
+          "per_thread": per_thread
+      }
+      print("{0} {1}: fixed {2} + {3} per thread".format(
+          mode, name, format_seconds(max(fixed, 0)),
+          format_seconds(max(per_thread, 0))))
+    profile["modes"][mode] = commands
+  with open(my_args.output, "wt") as f:
+    json.dump(profile, f, indent=2)
+  print("Calibration profile: " + my_args.output)
+
+
+def get_calibrated_overhead(args):
+  # The overhead of a run of the null command `true` at args.threads
+  with open(args.calibration) as f:
+    profile = json.load(f)
+  mode = "no_perf" if args.no_perf else "perf"
+  c = profile["modes"].get(mode, {}).get(CALIBRATION_COMMANDS[0][0])
+  if not c:
+    print("No {0} calibration in {1}".format(mode, args.calibration))
+    return 0
+  return max(c["fixed"] + c["per_thread"] * args.threads, 0)
+
+
+def calibration_noop():
+  pass
+
+
+def bench(argv):
+  parser = argparse.ArgumentParser(
+      prog="runs.py bench",
+      description='Runs the benchmark suite of runs.py itself into a result '
+      'db. Tags are harness/<label>/<scenario> so that two labels can be '
+      'checked with `runs.py compare`.')
+  parser.add_argument('--db', required=True, help="The path of the result db")
+  parser.add_argument(
+      '--label',
+      default="current",
+      help="The label of the harness version under test")
+  parser.add_argument(
+      '-r', '--runs', help="The number of runs", type=int, default=1000)
+  my_args = parser.parse_args(argv)
+  noop = "{0}:calibration_noop".format(
+      os.path.splitext(os.path.basename(__file__))[0])
+  for name, scenario_argv, cmds in HARNESS_BENCH_SCENARIOS:
+    tag = "harness/{0}/{1}".format(my_args.label, name)
+    argv = scenario_argv + [
+        "-r",
+        str(my_args.runs), "--no_perf", "--report_tag", tag, "--result_db",
+        my_args.db
+    ]
+    if not cmds:
+      argv += ["--callable", noop]
+    args = build_parser().parse_args(argv)
+    print("Bench: " + tag)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    run(args, cmds)
+  query(["--db", my_args.db, "--group_by", "tag", "-p", "50,99"])
+
+
+def parse_percentiles(s):
+  return [float(p) for p in s.split(",")]
+
+
+def parse_rate(s):
+  if s.endswith("/s"):
+    s = s[:-2]
+  return float(s)
+
+
+def build_parser():
   parser = argparse.ArgumentParser(description='Runs command')
   parser.add_argument(
       '-r', '--runs', help="The number of runs", type=int, default=1)
@@ -323,6 +2144,62 @@ def main():
       help="The number of concurrent execution",
       type=int,
       default=1)
+  parser.add_argument(
+      "--warmup",
+      type=int,
+      default=0,
+      help="The number of runs to discard from the stats before measuring")
+  parser.add_argument(
+      "--target_ci",
+      type=float,
+      help="Keep running until the 95%% CI of the run time percentile is "
+      "narrower than this percent of its value")
+  parser.add_argument(
+      "--ci_percentile",
+      type=float,
+      default=50,
+      help="The run time percentile used by --target_ci")
+  parser.add_argument(
+      "--max_runs",
+      type=int,
+      default=1000,
+      help="The maximum number of runs with --target_ci")
+  parser.add_argument(
+      "--rate",
+      type=parse_rate,
+      help="Start runs at this fixed rate (N or N/s) instead of closed-loop")
+  parser.add_argument(
+      "--max_inflight",
+      type=int,
+      default=0,
+      help="The maximum number of concurrent runs with --rate (0 for no limit)")
+  parser.add_argument(
+      "--pin",
+      choices=["none", "slot", "numa", "list"],
+      default="none",
+      help="Pin each run to the cores of its worker slot, the NUMA node of "
+      "its slot or the --cpus list")
+  parser.add_argument(
+      "--cpus",
+      type=str,
+      help="The CPU list (e.g. 0-3,8-11) to pin runs to (default: all)")
+  parser.add_argument(
+      "--calibration",
+      type=str,
+      help="The profile from `runs.py calibrate` to report overhead from")
+  parser.add_argument(
+      "--subtract_calibration",
+      action="store_true",
+      help="Also report run times less the calibrated overhead")
+  parser.add_argument(
+      "--callable",
+      type=str,
+      help="Benchmark module:function in-process instead of a command")
+  parser.add_argument(
+      "--pool",
+      choices=["thread", "process"],
+      default="thread",
+      help="The kind of warm workers running --callable")
   parser.add_argument(
       "-v", "--verbose", action="store_true", help="increase output verbosity")
   parser.add_argument(
@@ -338,19 +2215,100 @@ def main():
       help="The user-defined tag to be inserted in the report")
   parser.add_argument(
       "--report_file", type=str, help="The file to append the line for the run")
+  parser.add_argument(
+      "--result_db",
+      type=str,
+      help="The sqlite db to record every run and system sample into")
+  parser.add_argument(
+      "--trace",
+      type=str,
+      help="The Chrome/Perfetto trace file to write the run timeline to")
+  parser.add_argument(
+      "--metrics_port",
+      type=int,
+      help="Serve live Prometheus metrics on this localhost port")
+  parser.add_argument(
+      "--metrics_window",
+      type=float,
+      default=60,
+      help="The window (seconds) of the live run time percentiles")
+  parser.add_argument(
+      "--sample_rate",
+      type=float,
+      default=10,
+      help="The rate (Hz) of sampling system stats from /proc (0 to disable)")
+  parser.add_argument(
+      "--no_perf",
+      action="store_true",
+      help="Run the command directly without wrapping it in perf stat")
+  parser.add_argument(
+      "--perf_events",
+      type=str,
+      help="The comma-separated perf events to count (e.g. cycles:u,cycles:k)")
+  parser.add_argument(
+      "-p",
+      "--percentiles",
+      type=parse_percentiles,
+      default=PERCENTILES,
+      help="The comma-separated percentiles to report (e.g. 50,90,99,99.9)")
+  parser.add_argument(
+      "--metric",
+      type=parse_metric,
+      action="append",
+      help="A name=REGEX metric captured from the stdout of runs (repeatable)")
+  parser.add_argument(
+      "--bytes_per_run",
+      type=int,
+      help="The bytes each run transfers to derive MB/s from")
+  return parser
 
+
+def main():
+  parser = build_parser()
   argv = sys.argv
+  if len(argv) > 1 and argv[1] == "selftest":
+    selftest(argv[2:])
+    return 0
+  if len(argv) > 1 and argv[1] == "sweep":
+    sweep(argv[2:])
+    return 0
+  if len(argv) > 1 and argv[1] == "query":
+    query(argv[2:])
+    return 0
+  if len(argv) > 1 and argv[1] == "compare":
+    return compare(argv[2:])
+  if len(argv) > 1 and argv[1] == "calibrate":
+    calibrate(argv[2:])
+    return 0
+  if len(argv) > 1 and argv[1] == "bench":
+    bench(argv[2:])
+    return 0
   if "--" not in argv:
-    parser.print_help()
-    return 1
-  idx = argv.index("--")
-  argv = sys.argv[1:idx]
-  cmds = sys.argv[idx + 1:]
-
-  args = parser.parse_args(argv)
+    args = parser.parse_args(argv[1:])
+    if not args.callable:
+      parser.print_help()
+      return 1
+    cmds = []
+  else:
+    idx = argv.index("--")
+    argv = sys.argv[1:idx]
+    cmds = sys.argv[idx + 1:]
+    args = parser.parse_args(argv)
+  if args.callable and (cmds or args.rate or args.target_ci or args.metric):
+    parser.error("--callable cannot be used with a command, --rate, "
+                 "--target_ci or --metric")
+  if args.callable:
+    # Validates the spec before any worker or perf is started
+    try:
+      load_callable(args.callable)
+    except Exception as e:
+      parser.error("cannot load --callable {0}: {1!r}".format(args.callable, e))
+  if args.pin == "slot" and args.rate and args.max_inflight <= 0:
+    parser.error("--pin slot with --rate needs --max_inflight to size slots")
+  if args.pin != "none" and cmds and not shutil.which("taskset"):
+    parser.error("--pin needs taskset to pin commands")
   run(args, cmds)
 
 
-# Note: Please install sysstat ifstat to get system stats
 if __name__ == "__main__":
-  main()
+  sys.exit(main())